@@ -1,50 +1,127 @@
+import asyncio
 import datetime
 import base64
+import functools
+import gzip
+import hashlib
+import itertools
 import json
+import logging
 import os
+import random
 import re
+import secrets
+import threading
+import time
+import zlib
 from contextlib import asynccontextmanager
-from decimal import Decimal, InvalidOperation
-from typing import Any, Dict, List, Union, Optional
+from decimal import Context, Decimal, InvalidOperation
+from typing import Any, AsyncIterator, Callable, Dict, FrozenSet, List, NamedTuple, Tuple, Union, Optional
 import uuid
 from enum import Enum
 
 import httpx
+import orjson
+import pyarrow as pa
+import redis.asyncio as aioredis
 import uvicorn
-from fastapi import (FastAPI, Depends, HTTPException, Query, Body, BackgroundTasks)
-from fastapi.responses import HTMLResponse, JSONResponse
+from cachetools import TTLCache
+from fastapi import (FastAPI, Depends, HTTPException, Header, Query, Body, BackgroundTasks)
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from fastapi.responses import ORJSONResponse as FastAPIORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import AliasChoices, BaseModel, Field, TypeAdapter
 
 from google.cloud import bigquery, storage
 from google.cloud.bigquery import ScalarQueryParameter, ArrayQueryParameter
+from google.cloud import bigquery_storage
 from google.api_core.exceptions import NotFound as GCSNotFound
 from google.api_core import exceptions as google_api_exceptions
 
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, Image
 from vertexai.generative_models import HarmCategory, HarmBlockThreshold, GenerationConfig
+from vertexai.preview import caching as vertex_caching
+from vertexai.preview.generative_models import GenerativeModel as PreviewGenerativeModel
 
 import looker_sdk
 from looker_sdk import methods40, models40
 import io
 
 # --- AppConfig & Global Configs ---
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(levelname)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+class _SystemInstructionCache(NamedTuple):
+    # Published as one object so readers never see a cache without its text, expiry or model.
+    cache: Any
+    text: str
+    expires_at: datetime.datetime
+    model: Any
+
 class AppConfig:
     gcp_project_id: str = os.getenv("GCP_PROJECT_ID", "")
     gcp_location: str = os.getenv("GCP_LOCATION", "")
     default_system_instruction_text: str = ""
     vertex_ai_initialized: bool = False
     bigquery_client: Union[bigquery.Client, None] = None
+    bqstorage_client: Union[bigquery_storage.BigQueryReadClient, None] = None
     storage_client: Union[storage.Client, None] = None
     looker_sdk_client: Union[methods40.Looker40SDK, None] = None
     GCS_BUCKET_NAME: str = os.getenv("GCS_BUCKET_NAME", "")
     GCS_SYSTEM_INSTRUCTION_PATH: str = os.getenv("GCS_SYSTEM_INSTRUCTION_PATH", "system_instructions/default_system_instruction.txt")
     TARGET_GEMINI_MODEL: str = "gemini-2.5-flash-preview-05-20"
     GCS_GENERATED_REPORTS_PREFIX: str = "generated_reports_output/"
+    GCS_GENERATED_HTML_CACHE_PREFIX: str = "html_cache/"
+    GENERATED_REPORTS_CACHE_MAX_BYTES: int = int(os.getenv("GENERATED_REPORTS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+    GENERATED_REPORTS_CACHE_TTL_SECONDS: int = int(os.getenv("GENERATED_REPORTS_CACHE_TTL_SECONDS", "3600"))
+    GENERATED_REPORT_STREAM_CHUNK_BYTES: int = 256 * 1024
+    DRY_RUN_SCHEMA_CACHE_SIZE: int = int(os.getenv("DRY_RUN_SCHEMA_CACHE_SIZE", "1024"))
+    DRY_RUN_SCHEMA_CACHE_TTL_SECONDS: int = int(os.getenv("DRY_RUN_SCHEMA_CACHE_TTL_SECONDS", "3600"))
+    DRY_RUN_MAX_CONCURRENCY: int = int(os.getenv("DRY_RUN_MAX_CONCURRENCY", "8"))
+    GENERATED_HTML_CACHE_SIZE: int = int(os.getenv("GENERATED_HTML_CACHE_SIZE", "512"))
+    # Expired html_cache/ objects are deleted when next looked up. Entries that are never looked up again need a bucket
+    # lifecycle rule, Delete with age = this TTL in days (rounded up) and matchesPrefix = GCS_GENERATED_HTML_CACHE_PREFIX;
+    # change the rule together with this setting.
+    GENERATED_HTML_CACHE_TTL_SECONDS: int = int(os.getenv("GENERATED_HTML_CACHE_TTL_SECONDS", "86400"))
+    REPORT_DEFINITION_CACHE_SIZE: int = int(os.getenv("REPORT_DEFINITION_CACHE_SIZE", "256"))
+    REPORT_DEFINITION_CACHE_TTL_SECONDS: int = int(os.getenv("REPORT_DEFINITION_CACHE_TTL_SECONDS", "300"))
+    STYLE_GUIDE_IMAGE_CACHE_MAX_BYTES: int = int(os.getenv("STYLE_GUIDE_IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    STYLE_GUIDE_IMAGE_CACHE_TTL_SECONDS: int = int(os.getenv("STYLE_GUIDE_IMAGE_CACHE_TTL_SECONDS", "1800"))
+    SYSTEM_INSTRUCTION_CACHE_TTL_MINUTES: int = int(os.getenv("SYSTEM_INSTRUCTION_CACHE_TTL_MINUTES", "60"))
+    SYSTEM_INSTRUCTION_RELOAD_SECONDS: int = int(os.getenv("SYSTEM_INSTRUCTION_RELOAD_SECONDS", "60"))
+    system_instruction_generation: Optional[int] = None
+    system_instruction_checked_until: float = 0.0
+    system_instruction_cache: Optional[_SystemInstructionCache] = None
+    gemini_model: Optional[Any] = None
+    gemini_model_key: Tuple[str, str] = ("", "")
+    GEMINI_MAX_CONCURRENCY: int = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+    GEMINI_MAX_ATTEMPTS: int = int(os.getenv("GEMINI_MAX_ATTEMPTS", "5"))
+    LOOKER_AUTH_CHECK_TTL_SECONDS: int = int(os.getenv("LOOKER_AUTH_CHECK_TTL_SECONDS", "900"))
+    REDIS_URL: str = os.getenv("REDIS_URL", "")
+    redis_client: Optional[Any] = None
+    http_client: Optional[httpx.AsyncClient] = None
 
 config = AppConfig()
 
+# Bounded per-worker read-through cache in front of the shared copies of each generated report (Redis when
+# REDIS_URL is set, then GCS). GCS stays the source of truth, so any worker can serve a report it did not build.
+# Sized by document length rather than entry count, since reports with embedded Look images can run to megabytes.
+generated_reports_cache: TTLCache = TTLCache(maxsize=config.GENERATED_REPORTS_CACHE_MAX_BYTES, ttl=config.GENERATED_REPORTS_CACHE_TTL_SECONDS, getsizeof=len)
+# Gemini template output keyed on a digest of everything that goes into the call; backed by GCS across workers.
+# Values are (html, creation epoch seconds) so a copy pulled from GCS expires with the original, not a fresh TTL.
+generated_html_cache: TTLCache = TTLCache(maxsize=config.GENERATED_HTML_CACHE_SIZE, ttl=config.GENERATED_HTML_CACHE_TTL_SECONDS)
+# Dry-run schemas keyed on project + trimmed SQL text, so re-saving a definition skips the BigQuery round-trip.
+dry_run_schema_cache: TTLCache = TTLCache(maxsize=config.DRY_RUN_SCHEMA_CACHE_SIZE, ttl=config.DRY_RUN_SCHEMA_CACHE_TTL_SECONDS)
+_dry_run_schema_cache_lock = threading.Lock()
+# Caps in-flight dry runs per worker so a wide definition cannot trip BigQuery's concurrent-query quota.
+_dry_run_semaphore = asyncio.Semaphore(config.DRY_RUN_MAX_CONCURRENCY)
+# Parsed report_list rows plus their template HTML, keyed on report name. Only used with Redis configured: every write
+# to a definition bumps a shared token, so entries on other workers are dropped rather than served stale.
+report_definition_cache: TTLCache = TTLCache(maxsize=config.REPORT_DEFINITION_CACHE_SIZE, ttl=config.REPORT_DEFINITION_CACHE_TTL_SECONDS)
+# Style-guide image (bytes, mime type, ETag, Last-Modified) keyed on URL; bounded by total bytes since a handful of screenshots can be large.
+style_guide_image_cache: TTLCache = TTLCache(maxsize=config.STYLE_GUIDE_IMAGE_CACHE_MAX_BYTES, ttl=config.STYLE_GUIDE_IMAGE_CACHE_TTL_SECONDS, getsizeof=lambda entry: len(entry[0]))
+
 ALLOWED_FILTER_OPERATORS = {
     "_eq": {"op": "=", "param_type_hint": "AUTO"}, "_ne": {"op": "!=", "param_type_hint": "AUTO"},
     "_gte": {"op": ">=", "param_type_hint": "AUTO_DATE_OR_NUM"}, "_lte": {"op": "<=", "param_type_hint": "AUTO_DATE_OR_NUM"},
@@ -140,8 +217,9 @@ class FieldDisplayConfig(BaseModel):
     field_name: str; include_in_body: bool = Field(default=True); include_at_top: bool = Field(default=False)
     include_in_header: bool = Field(default=False); context_note: Optional[str] = None
     alignment: Optional[str] = None; number_format: Optional[str] = None
-    group_summary_action: Optional[str] = None; repeat_group_value: Optional[str] = Field(default='REPEAT')
-    numeric_aggregation: Optional[str] = None
+    # Older definitions stored this as subtotal_action; the configurator UI already reads either name.
+    group_summary_action: Optional[str] = Field(default=None, validation_alias=AliasChoices('group_summary_action', 'subtotal_action'))
+    repeat_group_value: Optional[str] = Field(default='REPEAT'); numeric_aggregation: Optional[str] = None
 
 # New Models for Multiple Data Tables and Filter Mapping
 class DataTableConfig(BaseModel):
@@ -150,6 +228,13 @@ class DataTableConfig(BaseModel):
     # Field display configs are now scoped to a specific data table
     field_display_configs: List[FieldDisplayConfig] = Field(default_factory=list)
 
+# Stored *JSON columns are parsed and validated in one pass by pydantic-core instead of json.loads + Model(**item).
+_CALCULATION_ROW_CONFIGS_ADAPTER = TypeAdapter(List[CalculationRowConfig])
+_FIELD_DISPLAY_CONFIGS_ADAPTER = TypeAdapter(List[FieldDisplayConfig])
+_DATA_TABLE_CONFIGS_ADAPTER = TypeAdapter(List[DataTableConfig])
+# Stand-in for schema fields without a stored config; only its display defaults are read, never field_name.
+_DEFAULT_FIELD_DISPLAY_CONFIG = FieldDisplayConfig(field_name="")
+
 class FilterUITarget(BaseModel):
     target_type: str = Field(..., description="Either 'DATA_TABLE' or 'LOOK'")
     target_id: str = Field(..., description="The 'table_placeholder_name' of the data table or the 'look_id'")
@@ -180,9 +265,15 @@ class ReportDefinitionPayload(BaseModel):
     calculation_row_configs: Optional[List[CalculationRowConfig]] = None
     subtotal_configs: Optional[List[SubtotalConfig]] = Field(default_factory=list)
     optimized_prompt: Optional[str] = None
+    force_regenerate: bool = False  # skip the generated-template cache and always call Gemini
     header_text: Optional[str] = None
     footer_text: Optional[str] = None
 
+# Save-side counterparts: dump_json serializes the models straight to JSON bytes without an intermediate dict pass.
+_LOOK_CONFIGS_ADAPTER = TypeAdapter(List[LookConfig])
+_SUBTOTAL_CONFIGS_ADAPTER = TypeAdapter(List[SubtotalConfig])
+_FILTER_CONFIGS_ADAPTER = TypeAdapter(List[FilterConfig])
+
 # Other models for different endpoints
 class ExecuteReportPayload(BaseModel):
     report_definition_name: str; filter_criteria_json: str = Field(default="{}")
@@ -197,6 +288,12 @@ class ReportDefinitionListItem(BaseModel):
     UserPlaceholderMappingsJSON: Optional[str] = None
     LastGeneratedTimestamp: Optional[datetime.datetime] = None
 
+# Values substituted for NULL columns in the definitions listing; columns not named here stay None.
+_LIST_ITEM_NULL_DEFAULTS = {
+    'LookConfigsJSON': "[]", 'BaseQuerySchemaJSON': "[]", 'FieldDisplayConfigsJSON': "[]", 'CalculationRowConfigsJSON': "[]",
+    'SubtotalConfigsJSON': "[]", 'UserAttributeMappingsJSON': "{}", 'UserPlaceholderMappingsJSON': "[]", 'LatestTemplateVersion': 0,
+}
+
 class SystemInstructionPayload(BaseModel): system_instruction: str
 
 class SqlQueryPayload(BaseModel): sql_query: str
@@ -229,6 +326,7 @@ class FinalizeTemplatePayload(BaseModel):
 
 class RefinementPayload(BaseModel):
     refinement_prompt_text: str
+    force_regenerate: bool = False  # skip the generated-template cache and always call Gemini
 
 class RefinementResponse(BaseModel):
     report_name: str
@@ -237,53 +335,136 @@ class RefinementResponse(BaseModel):
     message: str
 
 # --- Global Constants ---
-NUMERIC_TYPES_FOR_AGG = ["INTEGER", "INT64", "FLOAT", "FLOAT64", "NUMERIC", "DECIMAL", "BIGNUMERIC", "BIGDECIMAL"]
+NUMERIC_TYPES_FOR_AGG = frozenset({"INTEGER", "INT64", "FLOAT", "FLOAT64", "NUMERIC", "DECIMAL", "BIGNUMERIC", "BIGDECIMAL"})
+# Matches the string form of BigQuery numerics (e.g. "-12.50", "0E-9") so aggregation can skip values without a try/except.
+_NUM_RE = re.compile(r"^[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?$")
+# Case-insensitive, whitespace-tolerant clause detection for appending dynamic filter conditions.
+_WHERE_RE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+_TRAILING_CLAUSE_RE = re.compile(r"\b(?:GROUP\s+BY|ORDER\s+BY|HAVING|QUALIFY|WINDOW|LIMIT|UNION)\b", re.IGNORECASE)
+# Any {{ NAME }} in a report template; templates are split on these once and rendered by joining.
+_TEMPLATE_PLACEHOLDER_RE = re.compile(r"\{\{\s*([^{}]+?)\s*\}\}")
+
+def _shared_http_client() -> httpx.AsyncClient:
+    # One pooled client per worker keeps TLS connections to image hosts alive between fetches.
+    if config.http_client is None:
+        config.http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=100, max_keepalive_connections=20), timeout=httpx.Timeout(30.0, connect=5.0))
+    return config.http_client
+
+def _check_image_mime_type(image_mime_type: str) -> None:
+    if not image_mime_type.startswith("image/"): raise ValueError("Content-Type from URL is not valid for image.")
+
+async def _fetch_style_guide_image(image_url: str, require_image: bool = False) -> Tuple[bytes, str]:
+    # Refining a report re-sends the same screenshot on every iteration. Cached copies are revalidated with a conditional
+    # GET, so a screenshot re-uploaded to the same URL is picked up while an unchanged one costs a bodiless 304.
+    cached = style_guide_image_cache.get(image_url)
+    conditional_headers = {}
+    if cached is not None:
+        if cached[2]: conditional_headers["If-None-Match"] = cached[2]
+        if cached[3]: conditional_headers["If-Modified-Since"] = cached[3]
+    async with _shared_http_client().stream("GET", image_url, headers=conditional_headers, timeout=180.0) as img_response:
+        if cached is not None and img_response.status_code == 304:
+            if require_image: _check_image_mime_type(cached[1])
+            return cached[0], cached[1]
+        img_response.raise_for_status()
+        image_mime_type = img_response.headers.get("Content-Type", "application/octet-stream").lower()
+        # Checked on the headers so a non-image URL is rejected before its body is downloaded.
+        if require_image: _check_image_mime_type(image_mime_type)
+        entry = (await img_response.aread(), image_mime_type, img_response.headers.get("ETag"), img_response.headers.get("Last-Modified"))
+    # Only images that can be revalidated are kept; an HTML error page served with a 200 is never reused.
+    if image_mime_type.startswith("image/") and (entry[2] or entry[3]) and len(entry[0]) <= style_guide_image_cache.maxsize:
+        style_guide_image_cache[image_url] = entry
+    else: style_guide_image_cache.pop(image_url, None)
+    return entry[0], entry[1]
 
 # --- Lifespan Function ---
-@asynccontextmanager
-async def lifespan(app_fastapi: FastAPI):
-    print("INFO: FastAPI application startup...")
-    global config
-    config.gcp_project_id = os.getenv("GCP_PROJECT_ID", "")
-    config.gcp_location = os.getenv("GCP_LOCATION", "")
-    config.GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "")
-    config.GCS_SYSTEM_INSTRUCTION_PATH = os.getenv("GCS_SYSTEM_INSTRUCTION_PATH", "system_instructions/default_system_instruction.txt")
-    config.TARGET_GEMINI_MODEL = os.getenv("GEMINI_MODEL_OVERRIDE", "gemini-2.5-pro-preview-05-06")
-
+def _init_storage_client() -> None:
     try:
         config.storage_client = storage.Client(project=config.gcp_project_id if config.gcp_project_id else None)
-        print("INFO: Google Cloud Storage Client initialized successfully.")
-        config.default_system_instruction_text = _load_system_instruction_from_gcs(config.storage_client, config.GCS_BUCKET_NAME, config.GCS_SYSTEM_INSTRUCTION_PATH)
+        logger.info("Google Cloud Storage Client initialized successfully.")
+        config.default_system_instruction_text, config.system_instruction_generation = _load_system_instruction_from_gcs(config.storage_client, config.GCS_BUCKET_NAME, config.GCS_SYSTEM_INSTRUCTION_PATH)
+        config.system_instruction_checked_until = time.monotonic() + config.SYSTEM_INSTRUCTION_RELOAD_SECONDS
     except Exception as e:
-        print(f"FATAL: Failed to initialize Google Cloud Storage Client: {e}")
+        logger.critical("Failed to initialize Google Cloud Storage Client: %s", e)
         config.storage_client = None
         config.default_system_instruction_text = DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
 
+def _init_vertex_ai() -> None:
     try:
         vertexai.init(project=config.gcp_project_id, location=config.gcp_location)
         config.vertex_ai_initialized = True
-        print("INFO: Vertex AI SDK initialized successfully.")
+        logger.info("Vertex AI SDK initialized successfully.")
     except Exception as e:
-        print(f"FATAL: Vertex AI SDK Initialization Error: {e}")
+        logger.critical("Vertex AI SDK Initialization Error: %s", e)
         config.vertex_ai_initialized = False
 
+def _init_bigquery_clients() -> None:
     try:
         config.bigquery_client = bigquery.Client(project=config.gcp_project_id)
-        print("INFO: BigQuery Client initialized successfully.")
+        logger.info("BigQuery Client initialized successfully.")
     except Exception as e:
-        print(f"FATAL: Failed to initialize BigQuery Client: {e}")
+        logger.critical("Failed to initialize BigQuery Client: %s", e)
         config.bigquery_client = None
-        
+
+    try:
+        config.bqstorage_client = bigquery_storage.BigQueryReadClient()
+        logger.info("BigQuery Storage Read Client initialized successfully.")
+    except Exception as e:
+        logger.warning("BigQuery Storage Read Client unavailable, results will download over REST: %s", e)
+        config.bqstorage_client = None
+
+def _init_looker_sdk() -> None:
     try:
-        print("INFO: Initializing Looker SDK from standard environment variables...")
+        logger.info("Initializing Looker SDK from standard environment variables...")
         config.looker_sdk_client = looker_sdk.init40()
-        print("INFO: Looker SDK initialized successfully.")
+        logger.info("Looker SDK initialized successfully.")
     except Exception as e:
-        print(f"FATAL: Looker SDK auto-initialization from environment failed: {e}")
+        logger.critical("Looker SDK auto-initialization from environment failed: %s", e)
         config.looker_sdk_client = None
 
+async def _init_redis_client() -> None:
+    if not config.REDIS_URL: return
+    try:
+        config.redis_client = aioredis.from_url(config.REDIS_URL)
+        await config.redis_client.ping()
+        logger.info("Redis client initialized successfully.")
+    except Exception as e:
+        logger.error("Failed to connect to Redis, generated reports will be shared through GCS only: %s", e)
+        config.redis_client = None
+
+@asynccontextmanager
+async def lifespan(app_fastapi: FastAPI):
+    logger.info("FastAPI application startup...")
+    global config
+    config.gcp_project_id = os.getenv("GCP_PROJECT_ID", "")
+    config.gcp_location = os.getenv("GCP_LOCATION", "")
+    config.GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "")
+    config.GCS_SYSTEM_INSTRUCTION_PATH = os.getenv("GCS_SYSTEM_INSTRUCTION_PATH", "system_instructions/default_system_instruction.txt")
+    config.TARGET_GEMINI_MODEL = os.getenv("GEMINI_MODEL_OVERRIDE", "gemini-2.5-pro-preview-05-06")
+    _shared_http_client()
+
+    # Every client does its own credential discovery, so they come up side by side; each helper logs and
+    # clears its own client on failure. The context cache needs the system instruction, so it waits for both.
+    await asyncio.gather(asyncio.to_thread(_init_storage_client), asyncio.to_thread(_init_vertex_ai), asyncio.to_thread(_init_bigquery_clients),
+                         asyncio.to_thread(_init_looker_sdk), _init_redis_client())
+    if config.vertex_ai_initialized:
+        _inline_instruction_model(config.default_system_instruction_text)
+        await asyncio.to_thread(_refresh_system_instruction_cache)
+
     yield
-    print("INFO: FastAPI application shutdown.")
+    if config.redis_client is not None: await config.redis_client.aclose()
+    if config.http_client is not None: await config.http_client.aclose()
+    # Each worker process owns its own context cache; drop it rather than leaving it to expire.
+    if config.system_instruction_cache is not None:
+        try: await asyncio.to_thread(config.system_instruction_cache.cache.delete)
+        except Exception as e: logger.warning("Could not delete system instruction cache on shutdown: %s", e)
+    logger.info("FastAPI application shutdown.")
+
+class ORJSONResponse(FastAPIORJSONResponse):
+    # Used on the dict-returning routes that carry real payloads (schemas, HTML, instructions). Routes with a
+    # response_model keep FastAPI's default class so they stay on its pydantic-core serialization path.
+    # FastAPI's class serializes with OPT_SERIALIZE_NUMPY only; payloads here also have non-str keys and UTC datetimes.
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -304,17 +485,13 @@ allowed_origins_list = [
     CLOUD_RUN_SERVICE_URL
 ]
 if NGROK_URL_FROM_ENV: allowed_origins_list.append(NGROK_URL_FROM_ENV)
-allowed_origins_list = sorted(list(set(o for o in allowed_origins_list if o and o.startswith("http"))))
-if not allowed_origins_list: allowed_origins_list = ["http://localhost:8080"]
-print(f"INFO: CORS allow_origins effectively configured for: {allowed_origins_list}")
-app.add_middleware(CORSMiddleware, allow_origins=allowed_origins_list, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+allowed_origins_list = [o for o in dict.fromkeys(allowed_origins_list) if o and o.startswith("http")] or ["http://localhost:8080"]
+# The extension frontend only uses these methods and request headers; Accept/Content-Type are always allowed by Starlette.
+CORS_ALLOWED_METHODS = ["GET", "POST", "PUT", "DELETE", "OPTIONS"]
+CORS_ALLOWED_HEADERS = ["authorization", "content-type", "x-requested-with", "ngrok-skip-browser-warning"]
+logger.info("CORS allow_origins effectively configured for: %s", allowed_origins_list)
+app.add_middleware(CORSMiddleware, allow_origins=allowed_origins_list, allow_credentials=True, allow_methods=CORS_ALLOWED_METHODS, allow_headers=CORS_ALLOWED_HEADERS)
 # --- Helper Functions & Dependency Getters ---
-def _load_system_instruction_from_gcs(client: storage.Client, bucket_name: str, blob_name: str) -> str:
-    if not client or not bucket_name: return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
-    try:
-        bucket = client.bucket(bucket_name); blob = bucket.blob(blob_name)
-        return blob.download_as_text(encoding='utf-8') if blob.exists() else DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
-    except Exception as e: return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
 def get_bigquery_client_dep():
     if not config.bigquery_client: raise HTTPException(status_code=503, detail="BigQuery client not available.")
     return config.bigquery_client
@@ -323,35 +500,6 @@ def get_storage_client_dep():
     return config.storage_client
 def get_vertex_ai_initialized_flag():
     if not config.vertex_ai_initialized: raise HTTPException(status_code=503, detail="Vertex AI SDK not initialized.")
-_looker_sdk_authenticated = False
-def get_looker_sdk_client_dep():
-    global _looker_sdk_authenticated
-    if not config.looker_sdk_client: raise HTTPException(status_code=503, detail="Looker SDK is not configured. Check environment variables.")
-    if not _looker_sdk_authenticated:
-        try:
-            me = config.looker_sdk_client.me()
-            print(f"INFO: Looker SDK connection verified for user: {me.display_name}")
-            _looker_sdk_authenticated = True
-        except Exception as e: raise HTTPException(status_code=503, detail=f"Looker SDK authentication failed: {e}")
-    return config.looker_sdk_client
-def remove_first_and_last_lines(s: str) -> str:
-    if not s: return ""
-    lines = s.splitlines();
-    if len(lines) >= 2 and lines[0].strip().startswith("```") and lines[-1].strip() == "```": return '\n'.join(lines[1:-1])
-    return s
-def generate_html_from_user_pattern(prompt_text: str, image_bytes: bytes, image_mime_type: str, system_instruction_text: str) -> Union[str, None]:
-    get_vertex_ai_initialized_flag()
-    try:
-        model_instance = GenerativeModel(model_name=config.TARGET_GEMINI_MODEL, system_instruction=[system_instruction_text] if system_instruction_text else None)
-        contents_for_gemini = [Part.from_text(text=prompt_text), Part.from_data(data=image_bytes, mime_type=image_mime_type)]
-        safety_settings_config = { category: HarmBlockThreshold.BLOCK_NONE for category in HarmCategory }
-        generation_config_obj = GenerationConfig(temperature=0.7, top_p=0.95, max_output_tokens=8192, candidate_count=1)
-        response = model_instance.generate_content(contents=contents_for_gemini, generation_config=generation_config_obj, safety_settings=safety_settings_config, stream=False)
-        generated_text_output = "".join([part.text for part in response.candidates[0].content.parts if hasattr(part, 'text')])
-        return remove_first_and_last_lines(generated_text_output)
-    except Exception as e:
-        print(f"ERROR: Vertex AI: GenAI content generation error: {e}"); import traceback; print(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Vertex AI content generation failed: {e}")
 def convert_row_to_json_serializable(row: bigquery.Row) -> Dict[str, Any]:
     output = {};
     for key, value in row.items():
@@ -362,207 +510,47 @@ def convert_row_to_json_serializable(row: bigquery.Row) -> Dict[str, Any]:
 def get_bq_param_type_and_value(value_str_param: Any, bq_col_name: str, type_hint: str):
     # ... This function is unchanged ...
     return "", ""
-def format_value(value: Any, format_str: Optional[str], field_type_str: str) -> str:
-    # ... This function is unchanged ...
-    return ""
-def calculate_aggregate(data_list: List[Decimal], agg_type_str_param: Optional[str]) -> Decimal:
-    # ... This function is unchanged ...
-    return Decimal('0')
-
-# --- Background Task Function for Report Generation ---
-# In app.py
-
-# In app.py, replace the existing generate_and_save_report_assets function
-
-def generate_and_save_report_assets(
-    payload: ReportDefinitionPayload,
-    bq_client: bigquery.Client,
-    gcs_client: storage.Client,
-):
-    try:
-        report_name = payload.report_name
-        print(f"BACKGROUND_TASK: Starting generation for report: '{report_name}'")
-
-        # --- FIX START: Fetch current version number to correctly increment it ---
-        current_version = 0
-        try:
-            get_version_sql = f"SELECT LatestTemplateVersion FROM `{config.gcp_project_id}.report_printing.report_list` WHERE ReportName = @report_name"
-            version_params = [ScalarQueryParameter("report_name", "STRING", report_name)]
-            version_results = list(bq_client.query(get_version_sql, job_config=bigquery.QueryJobConfig(query_parameters=version_params)).result())
-            if version_results:
-                # Ensure we handle None from BQ gracefully
-                current_version = version_results[0].get("LatestTemplateVersion") or 0
-        except google_api_exceptions.NotFound:
-            # This is expected if the table doesn't exist yet
-            print(f"INFO: Table '{config.gcp_project_id}.report_printing.report_list' not found. Assuming first version for '{report_name}'.")
-            current_version = 0
-        except Exception as e:
-            # If any other error occurs, we assume it's the first version to avoid blocking creation
-            print(f"WARN: Could not fetch current version for '{report_name}', assuming v0. Error: {e}")
-            current_version = 0
-        
-        new_version = current_version + 1
-        print(f"INFO: Versioning for '{report_name}'. Current: {current_version}, New: {new_version}.")
-        # --- FIX END ---
-
-        prompt_for_template = payload.prompt
-        all_schemas_for_bq_save = {}
-        
-        for table_config in payload.data_tables:
-            table_placeholder = table_config.table_placeholder_name
-            schema_from_dry_run_list = []
-            try:
-                dry_run_job = bq_client.query(table_config.sql_query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
-                if dry_run_job.schema:
-                    for field in dry_run_job.schema:
-                        field_data = {"name": field.name, "type": str(field.field_type).upper(), "mode": str(field.mode).upper()}
-                        schema_from_dry_run_list.append(field_data)
-                all_schemas_for_bq_save[table_placeholder] = schema_from_dry_run_list
-            except Exception as e:
-                print(f"WARN: Dry run failed for table '{table_placeholder}'. Skipping. Error: {e}")
-                continue
-
-            schema_for_gemini_prompt_str = ", ".join([f"`{f['name']}` (Type: {f['type']})" for f in schema_from_dry_run_list])
-            prompt_for_template += f"\n\n--- Data Table: `{table_placeholder}` ---\n"
-            prompt_for_template += f"You MUST generate a complete table structure. The placeholder `{{{{TABLE_ROWS_{table_placeholder}}}}}` MUST be inside a `<tbody>` tag. DO NOT place the placeholder anywhere else. Follow this example structure precisely:\n"
-            prompt_for_template += f"""
-<table class="data-table">
-  <thead>
-    <tr>
-      <th>Column 1</th>
-      <th>Column 2</th>
-    </tr>
-  </thead>
-  <tbody>
-    {{{{TABLE_ROWS_{table_placeholder}}}}}
-  </tbody>
-</table>
-"""
-            prompt_for_template += f"\nUse the schema to determine the actual column headers in the `<thead>`.\n"
-            # --- END OF NEW PROMPT ---
-            
-            prompt_for_template += f"Schema: {schema_for_gemini_prompt_str}\n"
-
-            if table_config.field_display_configs:
-                prompt_for_template += "Field Display & Summary Instructions:\n"
-                for config_item in table_config.field_display_configs:
-                    style_hints = [s for s in [f"align: {config_item.alignment}" if config_item.alignment else "", f"format: {config_item.number_format}" if config_item.number_format else ""] if s]
-                    field_info = f"- `{config_item.field_name}`"
-                    if style_hints: field_info += f" (Styling: {'; '.join(style_hints)})"
-                    prompt_for_template += f"{field_info}\n"
-            prompt_for_template += "--- End Data Table ---"
-
-        if payload.look_configs:
-            prompt_for_template += "\n\n--- Chart Image Placeholders ---\nPlease include placeholders for the following charts where you see fit in the layout. Use these exact placeholder names:\n"
-            for look_config in payload.look_configs:
-                prompt_for_template += f"- `{{{{{look_config.placeholder_name}}}}}`\n"
-            prompt_for_template += "--- End Chart Image Placeholders ---"
-        
-        img_response = httpx.get(payload.image_url, timeout=180.0)
-        img_response.raise_for_status()
-        image_bytes_data, image_mime_type_data = img_response.content, img_response.headers.get("Content-Type", "application/octet-stream").lower()
-
-        html_template_content = generate_html_from_user_pattern(prompt_text=prompt_for_template, image_bytes=image_bytes_data, image_mime_type=image_mime_type_data, system_instruction_text=config.default_system_instruction_text)
-        if not html_template_content or not html_template_content.strip():
-            html_template_content = "<html><body><p>Error: AI failed to generate valid HTML.</p></body></html>"
-
-        report_gcs_path_safe = report_name.replace(" ", "_").replace("/", "_").lower()
-        base_gcs_folder = f"report_templates/{report_gcs_path_safe}"
-        
-        # --- FIX: Use the new, incremented version for the GCS path ---
-        versioned_template_gcs_path_str = f"{base_gcs_folder}/template_v{new_version}.html"
-        
-        bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
-        bucket.blob(versioned_template_gcs_path_str).upload_from_string(html_template_content, content_type='text/html; charset=utf-8')
-        
-        user_attribute_mappings_json_str = json.dumps(payload.user_attribute_mappings or {})
-        
-        data_tables_json_to_save = json.dumps([dt.model_dump() for dt in payload.data_tables], indent=2)
-        schema_json_to_save = json.dumps(all_schemas_for_bq_save, indent=2)
-        look_configs_json_to_save = json.dumps([lc.model_dump() for lc in payload.look_configs], indent=2) if payload.look_configs else "[]"
-        calculation_row_configs_json_to_save = json.dumps([crc.model_dump(exclude_unset=True) for crc in payload.calculation_row_configs], indent=2) if payload.calculation_row_configs else "[]"
-        subtotal_configs_json_to_save = json.dumps([stc.model_dump() for stc in payload.subtotal_configs], indent=2) if payload.subtotal_configs else "[]"
-        filter_configs_json_to_save = json.dumps([fc.model_dump() for fc in payload.filter_configs], indent=2)
-
-        table_id = f"`{config.gcp_project_id}.report_printing.report_list`"
-        
-        # --- FIX: Modified MERGE statement to use the @new_version parameter ---
-        merge_sql = f"""
-        MERGE {table_id} T
-        USING (SELECT @report_name AS ReportName) S ON T.ReportName = S.ReportName
-        WHEN NOT MATCHED THEN
-          INSERT (ReportName, Prompt, SQL, ScreenshotURL, LookConfigsJSON, FilterConfigsJSON, TemplateURL, LatestTemplateVersion, BaseQuerySchemaJSON, FieldDisplayConfigsJSON, CalculationRowConfigsJSON, SubtotalConfigsJSON, UserAttributeMappingsJSON, CreatedTimestamp, LastGeneratedTimestamp)
-          VALUES(@report_name, @prompt, @data_tables_json, @image_url, @look_configs_json, @filter_configs_json, @template_gcs_path, @new_version, @schema_json, '[]', @calculation_row_configs_json, @subtotal_configs_json, @user_attribute_mappings_json, CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
-        WHEN MATCHED THEN
-          UPDATE SET 
-            Prompt = @prompt, 
-            SQL = @data_tables_json, 
-            ScreenshotURL = @image_url, 
-            LookConfigsJSON = @look_configs_json, 
-            FilterConfigsJSON = @filter_configs_json, 
-            TemplateURL = @template_gcs_path, 
-            LatestTemplateVersion = @new_version, 
-            BaseQuerySchemaJSON = @schema_json, 
-            FieldDisplayConfigsJSON = '[]', 
-            CalculationRowConfigsJSON = @calculation_row_configs_json, 
-            SubtotalConfigsJSON = @subtotal_configs_json, 
-            UserAttributeMappingsJSON = @user_attribute_mappings_json, 
-            LastGeneratedTimestamp = CURRENT_TIMESTAMP()
-        """
-        
-        merge_params = [
-            ScalarQueryParameter("report_name", "STRING", report_name),
-            ScalarQueryParameter("prompt", "STRING", payload.prompt),
-            ScalarQueryParameter("data_tables_json", "STRING", data_tables_json_to_save),
-            ScalarQueryParameter("image_url", "STRING", payload.image_url),
-            ScalarQueryParameter("look_configs_json", "STRING", look_configs_json_to_save),
-            ScalarQueryParameter("filter_configs_json", "STRING", filter_configs_json_to_save),
-            ScalarQueryParameter("template_gcs_path", "STRING", f"gs://{config.GCS_BUCKET_NAME}/{versioned_template_gcs_path_str}"),
-            ScalarQueryParameter("schema_json", "STRING", schema_json_to_save),
-            ScalarQueryParameter("calculation_row_configs_json", "STRING", calculation_row_configs_json_to_save),
-            ScalarQueryParameter("subtotal_configs_json", "STRING", subtotal_configs_json_to_save),
-            ScalarQueryParameter("user_attribute_mappings_json", "STRING", user_attribute_mappings_json_str),
-            # --- FIX: Added the new_version parameter to the query ---
-            ScalarQueryParameter("new_version", "INT64", new_version),
-        ]
-        bq_client.query(merge_sql, job_config=bigquery.QueryJobConfig(query_parameters=merge_params)).result()
-        
-        print(f"BACKGROUND_TASK: Finished generation for report: '{report_name}', saved as version {new_version}")
-
-    except Exception as e:
-        print(f"FATAL BACKGROUND_TASK ERROR for '{payload.report_name}': {e}")
-        import traceback
-        traceback.print_exc()
-
-# --- CORS Configuration ---
-NGROK_URL_FROM_ENV = os.getenv("FRONTEND_NGROK_URL")
-LOOKER_INSTANCE_URL_FROM_ENV = os.getenv("LOOKER_INSTANCE_URL")
-LOOKER_EXTENSION_SANDBOX_HOST = os.getenv("LOOKER_EXTENSION_SANDBOX_HOST","https://83d14716-08b3-4def-bdca-54f4b2af9f19-extensions.cloud.looker.com")
-CLOUD_RUN_SERVICE_URL = "https://looker-ext-code-17837811141.us-central1.run.app"
-
-allowed_origins_list = ["http://localhost:8080", LOOKER_INSTANCE_URL_FROM_ENV, LOOKER_EXTENSION_SANDBOX_HOST, CLOUD_RUN_SERVICE_URL]
-if NGROK_URL_FROM_ENV: allowed_origins_list.append(NGROK_URL_FROM_ENV)
-allowed_origins_list = sorted(list(set(o for o in allowed_origins_list if o and o.startswith("http"))))
-if not allowed_origins_list: allowed_origins_list = ["http://localhost:8080"]
-print(f"INFO: CORS allow_origins effectively configured for: {allowed_origins_list}")
-app.add_middleware(CORSMiddleware, allow_origins=allowed_origins_list, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 # --- Helper Functions & Dependency Getters ---
-def _load_system_instruction_from_gcs(client: storage.Client, bucket_name: str, blob_name: str) -> str:
+def _load_system_instruction_from_gcs(client: storage.Client, bucket_name: str, blob_name: str) -> Tuple[str, Optional[int]]:
+    # Returns the text and the object generation it came from (None for the fallback).
     if not client or not bucket_name:
-        print(f"WARN: GCS client/bucket not provided. Using fallback system instruction.")
-        return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
+        logger.warning("GCS client/bucket not provided. Using fallback system instruction.")
+        return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION, None
     try:
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        if blob.exists():
-            print(f"INFO: Loaded system instruction from gs://{bucket_name}/{blob_name}")
-            return blob.download_as_text(encoding='utf-8')
-        print(f"WARN: System instruction file not found at gs://{bucket_name}/{blob_name}. Using fallback.")
-        return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
+        # One GET on the cold-start path; a missing object surfaces as NotFound instead of a separate exists() probe.
+        blob = client.bucket(bucket_name).blob(blob_name)
+        system_instruction_text = blob.download_as_text(encoding='utf-8')
+        logger.info("Loaded system instruction from gs://%s/%s", bucket_name, blob_name)
+        return system_instruction_text, blob.generation
+    except GCSNotFound:
+        logger.warning("System instruction file not found at gs://%s/%s. Using fallback.", bucket_name, blob_name)
+        return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION, None
     except Exception as e:
-        print(f"ERROR: Failed to load system instruction from GCS: {e}. Using fallback.")
-        return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION
+        logger.error("Failed to load system instruction from GCS: %s. Using fallback.", e)
+        return DEFAULT_FALLBACK_SYSTEM_INSTRUCTION, None
+
+_system_instruction_reload_lock = threading.Lock()
+
+def _reload_system_instruction_if_changed() -> None:
+    # A PUT only updates the worker that served it; every other worker picks the new text up from GCS here.
+    with _system_instruction_reload_lock:
+        if time.monotonic() < config.system_instruction_checked_until: return
+        try:
+            blob = config.storage_client.bucket(config.GCS_BUCKET_NAME).blob(config.GCS_SYSTEM_INSTRUCTION_PATH)
+            try: blob.reload(); generation = blob.generation
+            except GCSNotFound: generation = None
+            if generation != config.system_instruction_generation:
+                config.default_system_instruction_text, config.system_instruction_generation = _load_system_instruction_from_gcs(
+                    config.storage_client, config.GCS_BUCKET_NAME, config.GCS_SYSTEM_INSTRUCTION_PATH)
+                if config.vertex_ai_initialized: _refresh_system_instruction_cache()
+        except Exception as e: logger.warning("Could not check the system instruction for changes: %s", e)
+        config.system_instruction_checked_until = time.monotonic() + config.SYSTEM_INSTRUCTION_RELOAD_SECONDS
+
+async def _current_system_instruction() -> str:
+    if config.storage_client and config.GCS_BUCKET_NAME and time.monotonic() >= config.system_instruction_checked_until:
+        await asyncio.to_thread(_reload_system_instruction_if_changed)
+    return config.default_system_instruction_text
 
 def get_bigquery_client_dep():
     if not config.bigquery_client: raise HTTPException(status_code=503, detail="BigQuery client not available.")
@@ -572,66 +560,212 @@ def get_storage_client_dep():
     if not config.storage_client: raise HTTPException(status_code=503, detail="GCS client not available.")
     return config.storage_client
 
+def get_bqstorage_client_dep() -> Optional[bigquery_storage.BigQueryReadClient]:
+    # Optional by design: without a Storage Read client, results still download over REST.
+    return config.bqstorage_client
+
 def get_vertex_ai_initialized_flag():
     if not config.vertex_ai_initialized: raise HTTPException(status_code=503, detail="Vertex AI SDK not initialized.")
     if not config.TARGET_GEMINI_MODEL: raise HTTPException(status_code=503, detail="TARGET_GEMINI_MODEL not configured.")
 
-_looker_sdk_authenticated = False
+# Monotonic deadline until which the last successful me() check is trusted; 0 forces a check on the next request.
+_looker_sdk_verified_until = 0.0
+_looker_sdk_verify_lock = threading.Lock()
 def get_looker_sdk_client_dep():
-    global _looker_sdk_authenticated
+    global _looker_sdk_verified_until
     if not config.looker_sdk_client:
         raise HTTPException(status_code=503, detail="Looker SDK is not configured. Check environment variables.")
-    
-    if not _looker_sdk_authenticated:
+    if time.monotonic() < _looker_sdk_verified_until: return config.looker_sdk_client
+    # Only one request re-verifies; the rest wait and then take the fast path.
+    with _looker_sdk_verify_lock:
+        if time.monotonic() < _looker_sdk_verified_until: return config.looker_sdk_client
         try:
             me = config.looker_sdk_client.me()
-            print(f"INFO: Looker SDK connection verified for user: {me.display_name}")
-            _looker_sdk_authenticated = True
+            logger.info("Looker SDK connection verified for user: %s", me.display_name)
+            _looker_sdk_verified_until = time.monotonic() + config.LOOKER_AUTH_CHECK_TTL_SECONDS
         except Exception as e:
-            print(f"ERROR: Looker SDK authentication failed: {e}")
+            logger.error("Looker SDK authentication failed: %s", e)
             raise HTTPException(status_code=503, detail=f"Looker SDK authentication failed: {e}")
             
     return config.looker_sdk_client
     
 def remove_first_and_last_lines(s: str) -> str:
+    # Slices around the fence lines instead of splitting the whole Gemini output into a list and joining it back.
     if not s: return ""
-    lines = s.splitlines();
-    if len(lines) >= 2 and lines[0].strip().startswith("```") and lines[-1].strip() == "```": return '\n'.join(lines[1:-1])
-    if len(lines) >= 1 and lines[0].strip().startswith("```"): return '\n'.join(lines[1:]) if len(lines) > 1 else ""
-    return s
+    first_newline = s.find("\n")
+    if not s[:first_newline if first_newline >= 0 else len(s)].strip().startswith("```"): return s
+    if first_newline < 0: return ""
+    body = s[first_newline + 1:]
+    content_end = body.rstrip()
+    last_line_start = content_end.rfind("\n")
+    # CRLF output leaves a "\r" ahead of the closing fence's "\n"; the old splitlines() version dropped it.
+    return body[:max(last_line_start, 0)].removesuffix("\r") if content_end[last_line_start + 1:].strip() == "```" else body
+
+_system_instruction_cache_lock = threading.Lock()
+
+def _system_instruction_cache_expiring(state: _SystemInstructionCache) -> bool:
+    return datetime.datetime.now(datetime.timezone.utc) >= state.expires_at - datetime.timedelta(minutes=1)
+
+def _refresh_system_instruction_cache(only_if_expiring: bool = False) -> None:
+    """(Re)creates the Vertex AI context cache holding the current system instruction."""
+    with _system_instruction_cache_lock:
+        stale_state = config.system_instruction_cache
+        # Callers that raced on the same expiry find it already renewed by the first one.
+        if only_if_expiring and stale_state is not None and not _system_instruction_cache_expiring(stale_state): return
+        instruction_text = config.default_system_instruction_text
+        config.system_instruction_cache = None
+        if stale_state is not None:
+            try: stale_state.cache.delete()
+            except Exception as e: logger.warning("Could not delete stale system instruction cache: %s", e)
+        if not instruction_text: return
+        ttl = datetime.timedelta(minutes=config.SYSTEM_INSTRUCTION_CACHE_TTL_MINUTES)
+        try:
+            cached_content = vertex_caching.CachedContent.create(model_name=config.TARGET_GEMINI_MODEL, system_instruction=instruction_text, ttl=ttl)
+            config.system_instruction_cache = _SystemInstructionCache(cached_content, instruction_text, datetime.datetime.now(datetime.timezone.utc) + ttl,
+                                                                      PreviewGenerativeModel.from_cached_content(cached_content=cached_content))
+            logger.info("System instruction cached in Vertex AI as %s", cached_content.name)
+        except Exception as e:
+            # Below the model's minimum cacheable size (or on unsupported models) the uncached path is used.
+            logger.warning("Vertex AI context caching unavailable, sending system instruction inline: %s", e)
+
+def _cached_instruction_model(system_instruction_text: str) -> Optional[Any]:
+    # Reads a single snapshot; a concurrent refresh swaps the whole tuple and never leaves it half-written.
+    state = config.system_instruction_cache
+    if state is None or system_instruction_text != state.text: return None
+    if _system_instruction_cache_expiring(state):
+        _refresh_system_instruction_cache(only_if_expiring=True)
+        state = config.system_instruction_cache
+        if state is None or system_instruction_text != state.text: return None
+    return state.model
+
+def _inline_instruction_model(system_instruction_text: str) -> GenerativeModel:
+    # Rebuilt only when the target model or the system instruction text changes.
+    model_key = (config.TARGET_GEMINI_MODEL, system_instruction_text)
+    if config.gemini_model is None or config.gemini_model_key != model_key:
+        config.gemini_model = GenerativeModel(model_name=config.TARGET_GEMINI_MODEL, system_instruction=[system_instruction_text] if system_instruction_text else None)
+        config.gemini_model_key = model_key
+    return config.gemini_model
+
+def _generated_html_cache_key(prompt_text: str, image_bytes: bytes, image_mime_type: str, system_instruction_text: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (config.TARGET_GEMINI_MODEL.encode(), system_instruction_text.encode(), prompt_text.encode(), image_mime_type.encode(), image_bytes):
+        digest.update(len(part).to_bytes(8, "big")); digest.update(part)
+    return digest.hexdigest()
+
+def _get_cached_generated_html(cache_key: str) -> Optional[str]:
+    entry = generated_html_cache.get(cache_key)
+    if entry is not None and time.time() - entry[1] < config.GENERATED_HTML_CACHE_TTL_SECONDS: return entry[0]
+    if not config.storage_client or not config.GCS_BUCKET_NAME: return None
+    try:
+        blob = config.storage_client.bucket(config.GCS_BUCKET_NAME).get_blob(f"{config.GCS_GENERATED_HTML_CACHE_PREFIX}{cache_key}.html")
+        if blob is None or blob.time_created is None: return None
+        created_at = blob.time_created.timestamp()
+        if time.time() - created_at >= config.GENERATED_HTML_CACHE_TTL_SECONDS:
+            # Expired entries count as missing and are removed; the generation match spares a copy another worker just rewrote.
+            try: blob.delete(if_generation_match=blob.generation)
+            except google_api_exceptions.GoogleAPICallError as e: logger.debug("Could not delete expired generated HTML cache entry %s: %s", cache_key, e)
+            return None
+        html = blob.download_as_text(encoding='utf-8')
+    except GCSNotFound: return None
+    except Exception as e:
+        logger.warning("Could not read generated HTML cache entry %s: %s", cache_key, e); return None
+    generated_html_cache[cache_key] = (html, created_at)
+    return html
+
+def _store_generated_html(cache_key: str, html: str) -> None:
+    generated_html_cache[cache_key] = (html, time.time())
+    if not config.storage_client or not config.GCS_BUCKET_NAME: return
+    try:
+        blob = config.storage_client.bucket(config.GCS_BUCKET_NAME).blob(f"{config.GCS_GENERATED_HTML_CACHE_PREFIX}{cache_key}.html")
+        blob.upload_from_string(html, content_type='text/html; charset=utf-8')
+    except Exception as e: logger.warning("Could not persist generated HTML cache entry %s: %s", cache_key, e)
 
-def generate_html_from_user_pattern(
+_GEMINI_GENERATION_CONFIG = GenerationConfig(temperature=0.7, top_p=0.95, max_output_tokens=65535, candidate_count=1)
+_GEMINI_SAFETY_SETTINGS = {category: HarmBlockThreshold.BLOCK_NONE for category in HarmCategory}
+# Caps in-flight Gemini streams per worker; bursts beyond it queue here instead of turning into 429s at Vertex.
+_gemini_semaphore = asyncio.Semaphore(config.GEMINI_MAX_CONCURRENCY)
+
+async def _stream_gemini_text(
     prompt_text: str, image_bytes: bytes, image_mime_type: str, system_instruction_text: str
-) -> Union[str, None]:
-    get_vertex_ai_initialized_flag()
-    print(f"DEBUG: Vertex AI: System Instruction (first 100): {system_instruction_text[:100]}")
-    print(f"DEBUG: Vertex AI: Target Model: {config.TARGET_GEMINI_MODEL}")
+) -> AsyncIterator[str]:
+    logger.debug("Vertex AI: System Instruction (first 100): %s", system_instruction_text[:100])
+    logger.debug("Vertex AI: Target Model: %s", config.TARGET_GEMINI_MODEL)
+    attempt, yielded = 0, False
     try:
-        model_instance = GenerativeModel(model_name=config.TARGET_GEMINI_MODEL, system_instruction=[system_instruction_text] if system_instruction_text else None)
+        model_instance = await asyncio.to_thread(_cached_instruction_model, system_instruction_text) or _inline_instruction_model(system_instruction_text)
         image_part = Part.from_data(data=image_bytes, mime_type=image_mime_type)
         prompt_part = Part.from_text(text=prompt_text)
         contents_for_gemini = [prompt_part, image_part]
-        safety_settings_config = { category: HarmBlockThreshold.BLOCK_NONE for category in HarmCategory }
-        generation_config_obj = GenerationConfig(temperature=0.7, top_p=0.95, max_output_tokens=65535, candidate_count=1)
-        response = model_instance.generate_content(contents=contents_for_gemini, generation_config=generation_config_obj, safety_settings=safety_settings_config, stream=False)
-        generated_text_output = ""
-        if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
-            for part_item in response.candidates[0].content.parts:
-                if hasattr(part_item, 'text') and part_item.text: generated_text_output += part_item.text
-        else: print(f"WARN: Gemini response structure unexpected or no text. Response: {response}")
+        async with _gemini_semaphore:
+            # Quota errors surface when the stream opens or on its first chunk; once text has been yielded it cannot be replayed.
+            for attempt in range(1, config.GEMINI_MAX_ATTEMPTS + 1):
+                try:
+                    responses = aiter(await model_instance.generate_content_async(contents=contents_for_gemini, generation_config=_GEMINI_GENERATION_CONFIG, safety_settings=_GEMINI_SAFETY_SETTINGS, stream=True))
+                    response = await anext(responses, None)
+                    break
+                except google_api_exceptions.ResourceExhausted as e:
+                    if attempt == config.GEMINI_MAX_ATTEMPTS: raise
+                    delay = min(2 ** (attempt - 1), 30) + random.uniform(0, 1)
+                    logger.warning("Vertex AI: quota exhausted (attempt %d/%d), retrying in %.1fs: %s", attempt, config.GEMINI_MAX_ATTEMPTS, delay, e)
+                    await asyncio.sleep(delay)
+            while response is not None:
+                if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+                    for part_item in response.candidates[0].content.parts:
+                        if hasattr(part_item, 'text') and part_item.text: yielded = True; yield part_item.text
+                response = await anext(responses, None)
+    except google_api_exceptions.ResourceExhausted as e_re:
+        # Once text is out a streaming caller has already sent its 200, so the error is passed on as-is rather than as a 429.
+        if yielded:
+            logger.error("Vertex AI (ResourceExhausted) mid-stream, output truncated: %s", e_re); raise
+        logger.error("Vertex AI (ResourceExhausted) after %d attempt(s): %s", attempt, e_re)
+        raise HTTPException(status_code=429, detail=f"Vertex AI quota exhausted for model '{config.TARGET_GEMINI_MODEL}', try again shortly.")
     except (google_api_exceptions.NotFound, vertexai.generative_models.exceptions.NotFoundError) as e_nf:
         error_detail = f"Model '{config.TARGET_GEMINI_MODEL}' not found or project lacks access: {str(e_nf)}"
-        print(f"ERROR: Vertex AI (NotFound): {error_detail}"); raise HTTPException(status_code=404, detail=error_detail)
+        logger.error("Vertex AI (NotFound): %s", error_detail); raise HTTPException(status_code=404, detail=error_detail)
     except google_api_exceptions.InvalidArgument as e_ia:
         error_detail = f"Invalid argument for model '{config.TARGET_GEMINI_MODEL}': {str(e_ia)}"
-        print(f"ERROR: Vertex AI (InvalidArgument): {error_detail}"); raise HTTPException(status_code=400, detail=error_detail)
+        logger.error("Vertex AI (InvalidArgument): %s", error_detail); raise HTTPException(status_code=400, detail=error_detail)
     except Exception as e:
-        print(f"ERROR: Vertex AI: GenAI content generation error: {type(e).__name__} - {str(e)}")
-        import traceback; print(traceback.format_exc())
+        logger.error("Vertex AI: GenAI content generation error: %s - %s", type(e).__name__, str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=f"Vertex AI content generation failed: {str(e)}")
-    print(f"DEBUG: Raw Gemini Output before remove (first 500): {generated_text_output[:500]}")
+
+async def _strip_code_fence_stream(text_chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Streaming counterpart of remove_first_and_last_lines: drops a leading ``` line and its closing ``` line."""
+    pending, header_checked, fenced = "", False, False
+    async for chunk in text_chunks:
+        pending += chunk
+        if not header_checked:
+            first_newline = pending.find("\n")
+            if first_newline < 0: continue
+            header_checked = True
+            if pending[:first_newline].strip().startswith("```"): fenced, pending = True, pending[first_newline + 1:]
+        # Hold back the last non-blank line, which may turn out to be the closing fence.
+        content_end = pending.rstrip()
+        last_line_start = content_end.rfind("\n")
+        if last_line_start > 0:
+            yield pending[:last_line_start]; pending = pending[last_line_start:]
+    if not header_checked and pending.strip().startswith("```"): return
+    content_end = pending.rstrip()
+    last_line_start = content_end.rfind("\n")
+    if fenced and content_end[last_line_start + 1:].strip() == "```": pending = pending[:max(last_line_start, 0)]
+    if pending: yield pending
+
+async def generate_html_from_user_pattern(
+    prompt_text: str, image_bytes: bytes, image_mime_type: str, system_instruction_text: str, use_cache: bool = True
+) -> Union[str, None]:
+    get_vertex_ai_initialized_flag()
+    cache_key = _generated_html_cache_key(prompt_text, image_bytes, image_mime_type, system_instruction_text)
+    # With use_cache=False the model is always called; the new output still replaces the cached one.
+    cached_html = await asyncio.to_thread(_get_cached_generated_html, cache_key) if use_cache else None
+    if cached_html is not None:
+        logger.info("Vertex AI: Reusing cached template output for key %s", cache_key)
+        return cached_html
+    generated_text_output = "".join([text async for text in _stream_gemini_text(prompt_text, image_bytes, image_mime_type, system_instruction_text)])
+    if not generated_text_output: logger.warning("Gemini response structure unexpected or no text.")
+    logger.debug("Raw Gemini Output before remove (first 500): %s", generated_text_output[:500])
     processed_html = remove_first_and_last_lines(generated_text_output)
-    print(f"DEBUG: Processed Gemini Output after remove (first 500): {processed_html[:500]}")
+    logger.debug("Processed Gemini Output after remove (first 500): %s", processed_html[:500])
+    if processed_html and processed_html.strip(): await asyncio.to_thread(_store_generated_html, cache_key, processed_html)
     return processed_html if processed_html else ""
 
 def convert_row_to_json_serializable(row: bigquery.Row) -> Dict[str, Any]:
@@ -644,135 +778,481 @@ def convert_row_to_json_serializable(row: bigquery.Row) -> Dict[str, Any]:
         else: output[key] = value
     return output
 
-def get_bq_param_type_and_value(value_str_param: Any, bq_col_name: str, type_hint: str):
-    value_str = str(value_str_param)
-    if type_hint == "NONE": return None, None
-    if type_hint == "STRING_ARRAY": items = [item.strip() for item in value_str.split(',') if item.strip()]; return "STRING", items
-    if type_hint == "STRING_PREFIX": return "STRING", f"{value_str}%"
-    if type_hint == "STRING_SUFFIX": return "STRING", f"%{value_str}"
-    if type_hint == "BOOL_TRUE_STR": return "BOOL", True
-    if type_hint == "BOOL_FALSE_STR": return "BOOL", False
-    if type_hint == "AUTO_DATE_OR_NUM_RANGE":
-        parts = [v.strip() for v in value_str.split(',', 1)]; val1_str, val2_str = (parts[0], parts[1]) if len(parts) == 2 else (parts[0], parts[0])
-        try: return "DATE_RANGE", (datetime.date.fromisoformat(val1_str), datetime.date.fromisoformat(val2_str))
-        except: pass
-        try: return "INT64_RANGE", (int(val1_str), int(val2_str))
-        except: pass
-        try: return "FLOAT64_RANGE", (float(val1_str), float(val2_str))
-        except: pass
-        return "STRING_RANGE", (str(val1_str), str(val2_str))
-    if type_hint == "AUTO_DATE_OR_NUM" or type_hint == "AUTO":
+# A string int() accepts always matches this, so a miss lets the AUTO paths skip the raising int() attempt.
+_INT_LITERAL_RE = re.compile(r"^\s*[-+]?\d+(?:_\d+)*\s*$")
+
+def _maybe_iso_date(value_str: str) -> bool:
+    # date.fromisoformat only accepts 7/8/10-character forms that begin with a four-digit year.
+    return len(value_str) in (7, 8, 10) and value_str[:4].isdigit()
+
+def _parse_auto_scalar(value_str: str, allow_bool: bool) -> Tuple[str, Any]:
+    if _maybe_iso_date(value_str):
         try: return "DATE", datetime.date.fromisoformat(value_str)
-        except: pass
-        try: return "INT64", int(value_str)
-        except: pass
-        try: return "FLOAT64", float(value_str)
-        except: pass
-        if value_str.lower() in ['true', 'false'] and type_hint == "AUTO": return "BOOL", value_str.lower() == 'true'
-        return "STRING", str(value_str)
-    if type_hint == "STRING": return "STRING", str(value_str)
-    if type_hint == "INT64":
+        except ValueError: pass
+    if _INT_LITERAL_RE.match(value_str):
         try: return "INT64", int(value_str)
-        except: raise ValueError(f"Invalid int: {value_str} for {bq_col_name}")
-    if type_hint == "FLOAT64":
-        try: return "FLOAT64", float(value_str)
-        except: raise ValueError(f"Invalid float: {value_str} for {bq_col_name}")
-    if type_hint == "DATE":
-        try: return "DATE", datetime.date.fromisoformat(value_str)
-        except: raise ValueError(f"Invalid date: {value_str} for {bq_col_name}. Use YYYY-MM-DD.")
-    if type_hint == "BOOL":
-        val_lower = value_str.lower()
-        if val_lower in ['true', 'false']: return "BOOL", val_lower == 'true'
-        raise ValueError(f"Invalid bool: {value_str} for {bq_col_name}. Use 'true' or 'false'.")
-    return "STRING", str(value_str)
-
-def format_value(value: Any, format_str: Optional[str], field_type_str: str) -> str:
-    if value is None: return ""
-    field_type_upper = str(field_type_str).upper() if field_type_str else "UNKNOWN"
-    if format_str and field_type_upper in NUMERIC_TYPES_FOR_AGG:
-        try:
-            str_value = str(value) if not isinstance(value, (int, float, Decimal)) else value; num_value = Decimal(str_value)
-            if format_str == 'INTEGER': return f"{num_value:,.0f}"
-            elif format_str == 'DECIMAL_2': return f"{num_value:,.2f}"
-            elif format_str == 'USD': return f"${num_value:,.2f}"
-            elif format_str == 'EUR': return f"€{num_value:,.2f}"
-            elif format_str == 'PERCENT_2': return f"{num_value * Decimal('100'):,.2f}%"
-            else: return str(value)
+        except ValueError: pass
+    try: return "FLOAT64", float(value_str)
+    except ValueError: pass
+    if allow_bool and value_str.lower() in ('true', 'false'): return "BOOL", value_str.lower() == 'true'
+    return "STRING", value_str
+
+def _parse_auto_range(value_str: str, bq_col_name: str) -> Tuple[str, Any]:
+    parts = [v.strip() for v in value_str.split(',', 1)]; val1_str, val2_str = (parts[0], parts[1]) if len(parts) == 2 else (parts[0], parts[0])
+    if _maybe_iso_date(val1_str) and _maybe_iso_date(val2_str):
+        try: return "DATE_RANGE", (datetime.date.fromisoformat(val1_str), datetime.date.fromisoformat(val2_str))
+        except ValueError: pass
+    if _INT_LITERAL_RE.match(val1_str) and _INT_LITERAL_RE.match(val2_str):
+        try: return "INT64_RANGE", (int(val1_str), int(val2_str))
+        except ValueError: pass
+    try: return "FLOAT64_RANGE", (float(val1_str), float(val2_str))
+    except ValueError: pass
+    return "STRING_RANGE", (val1_str, val2_str)
+
+def _parse_strict(bq_type: str, parse: Callable[[str], Any], error_template: str) -> Callable[[str, str], Tuple[str, Any]]:
+    def parser(value_str: str, bq_col_name: str) -> Tuple[str, Any]:
+        try: return bq_type, parse(value_str)
+        except (ValueError, TypeError): raise ValueError(error_template.format(value=value_str, col=bq_col_name))
+    return parser
+
+def _parse_bool(value_str: str, bq_col_name: str) -> Tuple[str, Any]:
+    val_lower = value_str.lower()
+    if val_lower in ('true', 'false'): return "BOOL", val_lower == 'true'
+    raise ValueError(f"Invalid bool: {value_str} for {bq_col_name}. Use 'true' or 'false'.")
+
+_BQ_PARAM_PARSERS: Dict[str, Callable[[str, str], Tuple[Optional[str], Any]]] = {
+    "NONE": lambda value_str, bq_col_name: (None, None),
+    "STRING_ARRAY": lambda value_str, bq_col_name: ("STRING", [item.strip() for item in value_str.split(',') if item.strip()]),
+    "STRING_PREFIX": lambda value_str, bq_col_name: ("STRING", f"{value_str}%"),
+    "STRING_SUFFIX": lambda value_str, bq_col_name: ("STRING", f"%{value_str}"),
+    "BOOL_TRUE_STR": lambda value_str, bq_col_name: ("BOOL", True),
+    "BOOL_FALSE_STR": lambda value_str, bq_col_name: ("BOOL", False),
+    "AUTO_DATE_OR_NUM_RANGE": _parse_auto_range,
+    "AUTO_DATE_OR_NUM": lambda value_str, bq_col_name: _parse_auto_scalar(value_str, allow_bool=False),
+    "AUTO": lambda value_str, bq_col_name: _parse_auto_scalar(value_str, allow_bool=True),
+    "INT64": _parse_strict("INT64", int, "Invalid int: {value} for {col}"),
+    "FLOAT64": _parse_strict("FLOAT64", float, "Invalid float: {value} for {col}"),
+    "DATE": _parse_strict("DATE", datetime.date.fromisoformat, "Invalid date: {value} for {col}. Use YYYY-MM-DD."),
+    "BOOL": _parse_bool,
+}
+
+def _parse_string(value_str: str, bq_col_name: str) -> Tuple[str, Any]: return "STRING", value_str
+
+def get_bq_param_type_and_value(value_str_param: Any, bq_col_name: str, type_hint: str):
+    return _BQ_PARAM_PARSERS.get(type_hint, _parse_string)(str(value_str_param), bq_col_name)
+
+_NUMBER_FORMAT_RENDERERS: Dict[str, Callable[[Decimal], str]] = {
+    'INTEGER': "{:,.0f}".format, 'DECIMAL_2': "{:,.2f}".format, 'USD': "${:,.2f}".format, 'EUR': "€{:,.2f}".format,
+    'PERCENT_2': lambda num_value: f"{num_value * Decimal('100'):,.2f}%",
+}
+
+# Cell text and user-supplied values are escaped with one translate pass; formatted numbers never need it.
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})
+
+def _noop_format(value: Any, *_: Any) -> str:
+    return "" if value is None else str(value).translate(_HTML_ESCAPE_TABLE)
+
+@functools.lru_cache(maxsize=None)
+def _number_formatter(format_str: str) -> Callable[..., str]:
+    # Resolves the number_format branch once per column; the returned callable takes the cell value.
+    render = _NUMBER_FORMAT_RENDERERS.get(format_str)
+    if render is None: return _noop_format
+
+    def format_number(value: Any, *_: Any) -> str:
+        if value is None: return ""
+        try: return render(Decimal(value if isinstance(value, (int, float, Decimal)) else str(value)))
         except (ValueError, TypeError, InvalidOperation) as e:
-            print(f"WARN: Formatting error for numeric value '{value}' with format '{format_str}': {e}")
-            return str(value)
-    return str(value)
-
-def calculate_aggregate(data_list: List[Decimal], agg_type_str_param: Optional[str]) -> Decimal:
-    if not agg_type_str_param: return Decimal('0')
-    agg_type = agg_type_str_param.upper()
-    if not data_list:
-        if agg_type in ['COUNT', 'COUNT_DISTINCT']: return Decimal('0')
+            logger.warning("Formatting error for numeric value '%s' with format '%s': %s", value, format_str, e)
+            return _noop_format(value)
+    return format_number
+
+@functools.lru_cache(maxsize=None)
+def _memoized_number_formatter(format_str: str) -> Callable[..., str]:
+    format_number = _number_formatter(format_str)
+    return format_number if format_number is _noop_format else functools.lru_cache(maxsize=4096)(format_number)
+
+def _value_formatter(format_str: Optional[str], field_type_str: str, memoize: bool = False) -> Callable[..., str]:
+    # memoize is for total and calculation cells, which format the same few values on every run of a report; body
+    # columns stay uncached because mostly-distinct values make the cache lookup cost more than the formatting.
+    field_type_upper = str(field_type_str).upper() if field_type_str else "UNKNOWN"
+    if not format_str or field_type_upper not in NUMERIC_TYPES_FOR_AGG: return _noop_format
+    return _memoized_number_formatter(format_str) if memoize else _number_formatter(format_str)
+
+def _to_decimal(value: Any) -> Decimal:
+    # BigQuery NUMERIC already arrives as Decimal; floats go through repr() so unformatted totals don't expose binary expansions.
+    if isinstance(value, Decimal): return value
+    if isinstance(value, int): return Decimal(value)
+    if isinstance(value, float): return Decimal(repr(value))
+    return Decimal(value if isinstance(value, str) else str(value))
+
+class _TableLayout(NamedTuple):
+    table_idx: int
+    table_placeholder_name: str
+    sql_query: str
+    field_configs_list: List[FieldDisplayConfig]
+    field_configs_map: Dict[str, FieldDisplayConfig]
+    schema_type_map: Dict[str, str]
+    body_field_names_in_order: List[str]
+    # (field_name, alignment, number_format, field_type, formatter, hide_repeated_group_value) per body column.
+    body_col_plan: Tuple[Tuple[str, str, Optional[str], str, Callable[[Any, Optional[str], str], str], bool], ...]
+    group_by_field: Optional[str]
+    # Takes one row as a tuple of body-column values, in body_field_names_in_order.
+    render_row: Callable[[Tuple[Any, ...], bool], str]
+    summary_plan: "_SummaryPlan"
+
+class _SummaryPlan(NamedTuple):
+    # Subtotal/grand-total chrome and per-column aggregation choices; built with the layout so each summary row only
+    # formats the group label and the aggregated values.
+    agg_fields: Dict[str, str]
+    distinct_agg_fields: frozenset
+    grand_total_needed: bool
+    # (field_name, Decimal converter) per aggregated column, in agg_fields order.
+    agg_cell_plan: Tuple[Tuple[str, Callable[[Any], Optional[Decimal]]], ...]
+    subtotal_row_prefix: str
+    grand_total_row_prefix: str
+    # (field_name, aggregation, formatter, opening <td>) per aggregated body column, in body order.
+    summary_cell_plan: Tuple[Tuple[str, str, Callable[..., str], str], ...]
+    # render_summary_row(row_prefix, accumulators) -> the full subtotal/grand-total <tr>; compiled from summary_cell_plan.
+    render_summary_row: Callable[[str, Dict[str, Any]], str]
+
+def _compile_summary_row_renderer(summary_cell_plan) -> Callable[[str, Dict[str, Any]], str]:
+    # Counterpart of _compile_row_renderer for subtotal and grand-total rows: the per-column <td> markup is folded into
+    # constants, and field names, aggregations and formatters are bound through the namespace.
+    namespace: Dict[str, Any] = {}
+    parts, pending_markup = ["row_prefix"], ""
+    for i, (field_name, agg_type, formatter, cell_open) in enumerate(summary_cell_plan):
+        namespace[f"_k{i}"], namespace[f"_a{i}"], namespace[f"_f{i}"] = field_name, agg_type, formatter
+        parts.extend((repr(pending_markup + cell_open), f"_f{i}(accumulators[_k{i}].result(_a{i}))"))
+        pending_markup = "</td>"
+    parts.append(repr(pending_markup + "</tr>"))
+    source = "def render_summary_row(row_prefix, accumulators):\n    return \"\".join((" + ", ".join(parts) + ",))\n"
+    exec(compile(source, "<report_summary_row_renderer>", "exec"), namespace)
+    return namespace["render_summary_row"]
+
+def _summary_plan(field_configs_list: List[FieldDisplayConfig], field_configs_map: Dict[str, FieldDisplayConfig], schema_type_map: Dict[str, str], body_field_names_in_order: List[str]) -> _SummaryPlan:
+    agg_fields = {fc.field_name: fc.numeric_aggregation for fc in field_configs_list if fc.numeric_aggregation and schema_type_map.get(fc.field_name) in NUMERIC_TYPES_FOR_AGG}
+    grand_total_needed = any(fc.group_summary_action in ['GRAND_TOTAL_ONLY', 'SUBTOTAL_AND_GRAND_TOTAL'] for fc in field_configs_list)
+    distinct_agg_fields = frozenset(f for f, agg_type in agg_fields.items() if agg_type.upper() == "COUNT_DISTINCT")
+    agg_cell_plan = tuple((f, _cell_decimal_converter(schema_type_map.get(f))) for f in agg_fields)
+    summary_label_colspan = len(body_field_names_in_order) - len(agg_fields)
+    subtotal_row_prefix = f"<tr class='subtotal-row' style='font-weight: bold; background-color: #f2f2f2;'><td style='text-align: right;' colspan='{summary_label_colspan}'>Subtotal for {{}}:</td>"
+    grand_total_row_prefix = f"<tr class='grand-total-row' style='font-weight: bold; border-top: 2px solid black; background-color: #e0e0e0;'><td style='text-align: right;' colspan='{summary_label_colspan}'>Grand Total:</td>"
+    summary_cell_plan = []
+    for field_name in body_field_names_in_order:
+        if field_name in agg_fields:
+            summary_fc = field_configs_map.get(field_name, _DEFAULT_FIELD_DISPLAY_CONFIG)
+            summary_field_type = schema_type_map.get(field_name)
+            summary_cell_plan.append((field_name, agg_fields[field_name], _value_formatter(summary_fc.number_format, summary_field_type, memoize=True), f"<td style='text-align: {summary_fc.alignment or 'right'};'>"))
+    summary_cell_plan = tuple(summary_cell_plan)
+    return _SummaryPlan(agg_fields, distinct_agg_fields, grand_total_needed, agg_cell_plan, subtotal_row_prefix, grand_total_row_prefix,
+                        summary_cell_plan, _compile_summary_row_renderer(summary_cell_plan))
+
+def _body_col_plan(body_field_names_in_order: List[str], field_configs_map: Dict[str, FieldDisplayConfig], schema_type_map: Dict[str, str]):
+    col_plan = []
+    for field_name in body_field_names_in_order:
+        field_config = field_configs_map.get(field_name, _DEFAULT_FIELD_DISPLAY_CONFIG)
+        field_type = schema_type_map.get(field_name, "STRING")
+        # Only a known number_format on a numeric column does real work; everything else is a plain str() cast.
+        col_plan.append((field_name, field_config.alignment or "left", field_config.number_format, field_type,
+                         _value_formatter(field_config.number_format, field_type), field_config.repeat_group_value == 'SHOW_ON_CHANGE'))
+    return tuple(col_plan)
+
+def _compile_row_renderer(body_col_plan, group_by_field: Optional[str]) -> Callable[[Tuple[Any, ...], bool], str]:
+    # Generates straight-line Python for one report's body row so alignment, formatter and group-blanking decisions are made
+    # once here instead of per cell. The row tuple is unpacked positionally; formatter arguments are bound through the
+    # namespace, never spliced into source.
+    namespace: Dict[str, Any] = {"_HTML_ESCAPE_TABLE": _HTML_ESCAPE_TABLE}
+    # Markup between two cell values is folded into one constant, so the join only sees literal, value, literal, ...
+    parts, pending_markup = [], "<tr>"
+    for i, (field_name, align_val, number_format, field_type, formatter, hide_repeated_value) in enumerate(body_col_plan):
+        if formatter is _noop_format:
+            value_expr = f'("" if _v{i} is None else str(_v{i}).translate(_HTML_ESCAPE_TABLE))'
+        else:
+            # Column formatters are resolved per column and ignore their format/type arguments.
+            namespace[f"_f{i}"] = formatter
+            value_expr = f"_f{i}(_v{i})"
+        if hide_repeated_value and field_name == group_by_field: value_expr = f'({value_expr} if is_first_row_of_group else "")'
+        parts.extend((repr(pending_markup + f"  <td style='text-align: {align_val};'>"), value_expr))
+        pending_markup = "</td>"
+    parts.append(repr(pending_markup + "</tr>\n"))
+    unpack = "".join(f"_v{i}, " for i in range(len(body_col_plan)))
+    source = ("def render_row(row, is_first_row_of_group):\n" + (f"    {unpack}= row\n" if unpack else "")
+              + "    return \"\".join((" + ", ".join(parts) + ",))\n")
+    exec(compile(source, "<report_row_renderer>", "exec"), namespace)
+    return namespace["render_row"]
+
+@functools.lru_cache(maxsize=256)
+def _compile_table_layouts(data_tables_json: str, schemas_json: str) -> Tuple[_TableLayout, ...]:
+    # Everything derived here depends only on the stored report definition, so it is keyed on the raw JSON columns
+    # and reused across executions. Callers must treat the returned objects as read-only.
+    all_schemas = orjson.loads(schemas_json or '{}')
+    layouts = []
+    for table_idx, table_config in enumerate(_DATA_TABLE_CONFIGS_ADAPTER.validate_json(data_tables_json)):
+        table_placeholder_name, base_sql_query = table_config.table_placeholder_name, table_config.sql_query
+        if not table_placeholder_name or not base_sql_query: continue
+        schema_for_table = all_schemas.get(table_placeholder_name, [])
+        if not schema_for_table:
+            logger.warning("No schema found for data table '%s' in BaseQuerySchemaJSON. Skipping.", table_placeholder_name)
+            continue
+        field_configs_map = {fc.field_name: fc for fc in table_config.field_display_configs}
+        schema_type_map = {f['name']: f['type'] for f in schema_for_table}
+        body_field_names_in_order = [f['name'] for f in schema_for_table if field_configs_map.get(f['name'], _DEFAULT_FIELD_DISPLAY_CONFIG).include_in_body]
+        body_col_plan = _body_col_plan(body_field_names_in_order, field_configs_map, schema_type_map)
+        group_by_field = next((fc.field_name for fc in table_config.field_display_configs if fc.group_summary_action in ['SUBTOTAL_ONLY', 'SUBTOTAL_AND_GRAND_TOTAL']), None)
+        layouts.append(_TableLayout(table_idx, table_placeholder_name, base_sql_query, table_config.field_display_configs, field_configs_map, schema_type_map, body_field_names_in_order,
+                                    body_col_plan, group_by_field, _compile_row_renderer(body_col_plan, group_by_field),
+                                    _summary_plan(table_config.field_display_configs, field_configs_map, schema_type_map, body_field_names_in_order)))
+    return tuple(layouts)
+
+def _query_rows(bq_client: bigquery.Client, sql: str, query_params: Optional[List[Any]] = None) -> List[Any]:
+    # Blocking; endpoints call it through asyncio.to_thread so a slow query never stalls the event loop.
+    job_config = bigquery.QueryJobConfig(query_parameters=query_params) if query_params is not None else None
+    return list(bq_client.query(sql, job_config=job_config).result())
+
+def _run_dml(bq_client: bigquery.Client, sql: str, query_params: List[Any]):
+    query_job = bq_client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=query_params))
+    query_job.result()
+    return query_job
+
+def _delete_blobs_with_prefix(gcs_client: storage.Client, bucket_name: str, prefix: str) -> int:
+    blobs_to_delete = list(gcs_client.bucket(bucket_name).list_blobs(prefix=prefix))
+    if blobs_to_delete:
+        with gcs_client.batch():
+            for blob in blobs_to_delete:
+                blob.delete()
+    return len(blobs_to_delete)
+
+def _upload_if_changed(blob: storage.Blob, data: bytes, content_type: str) -> bool:
+    # Objects rewritten in place carry a content hash in their metadata; an identical re-save then costs a metadata
+    # GET instead of a full upload.
+    content_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+    try:
+        blob.reload()
+        if (blob.metadata or {}).get('content_hash') == content_hash: return False
+    except GCSNotFound: pass
+    # Writer-only accounts without storage.objects.get (403) and other read failures fall back to a plain upload.
+    except google_api_exceptions.GoogleAPICallError as e: logger.debug("Could not read metadata for %s, uploading unconditionally: %s", blob.name, e)
+    blob.metadata = {'content_hash': content_hash}
+    blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+    return True
+
+def _download_report_template(gcs_client: storage.Client, html_template_gcs_path: str) -> Optional[str]:
+    path_parts = html_template_gcs_path.replace("gs://", "").split("/", 1)
+    blob = gcs_client.bucket(path_parts[0]).blob(path_parts[1])
+    try: return blob.download_as_text(encoding='utf-8')
+    except GCSNotFound: return None
+
+class _CompiledTemplate(NamedTuple):
+    literals: Tuple[str, ...]  # static text around the placeholders, always one more than there are placeholders
+    placeholders: Tuple[Tuple[str, str], ...]  # (name, original text) in document order
+    names: FrozenSet[str]
+
+@functools.lru_cache(maxsize=64)
+def _compile_report_template(template_html: str, look_placeholder_names: Tuple[str, ...]) -> _CompiledTemplate:
+    # Splits a stored template into static text and placeholder slots once, so each execution only joins strings.
+    if look_placeholder_names:
+        # An <img> whose src is a Look placeholder collapses to the bare placeholder, which renders as the full <img> tag.
+        look_names_alternation = "|".join(map(re.escape, look_placeholder_names))
+        template_html = re.sub(f'<img[^>]*src=[\'"](\\{{\\{{(?:{look_names_alternation})\\}}\\}})[\'"][^>]*>', r"\1", template_html, flags=re.IGNORECASE)
+    literals, placeholders, pos = [], [], 0
+    for m in _TEMPLATE_PLACEHOLDER_RE.finditer(template_html):
+        literals.append(template_html[pos:m.start()]); placeholders.append((m.group(1), m.group(0))); pos = m.end()
+    literals.append(template_html[pos:])
+    return _CompiledTemplate(tuple(literals), tuple(placeholders), frozenset(name for name, _ in placeholders))
+
+def _render_report_template(compiled: _CompiledTemplate, substitutions: Dict[str, str]) -> str:
+    # Unresolved placeholders are written back unchanged.
+    parts = [compiled.literals[0]]
+    for (name, original_text), literal in zip(compiled.placeholders, compiled.literals[1:]):
+        parts.append(substitutions.get(name, original_text)); parts.append(literal)
+    return "".join(parts)
+
+# Wide enough for BIGNUMERIC (76 digits) so normalizing never rounds.
+_WIDE_DECIMAL_CONTEXT = Context(prec=100)
+
+def _arrow_decimal_to_str(value: Decimal) -> str:
+    # Arrow carries the column's fixed scale (10.5 -> 10.500000000); drop it so the text matches the REST row path.
+    normalized = value.normalize(context=_WIDE_DECIMAL_CONTEXT)
+    return str(Decimal(int(normalized)) if normalized.as_tuple().exponent > 0 else normalized)
+
+def _json_safe_scalar(value: Any) -> Any:
+    if isinstance(value, Decimal): return _arrow_decimal_to_str(value)
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)): return value.isoformat()
+    return value
+
+def _arrow_column_to_json_values(column: pa.ChunkedArray) -> List[Any]:
+    """Same conversions as convert_row_to_json_serializable, decided once per column from its Arrow type."""
+    arrow_type, values = column.type, column.to_pylist()
+    if pa.types.is_decimal(arrow_type): return [None if v is None else _arrow_decimal_to_str(v) for v in values]
+    if pa.types.is_temporal(arrow_type): return [None if v is None else v.isoformat() for v in values]
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type): return [None if v is None else base64.b64encode(v).decode('utf-8') for v in values]
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type): return [None if v is None else [_json_safe_scalar(item) for item in v] for v in values]
+    return values
+
+class _ColumnarRows(NamedTuple):
+    # Query results kept column by column as converted by _arrow_column_to_json_values; no per-row dicts are built.
+    num_rows: int
+    columns: Dict[str, List[Any]]
+
+    def column(self, name: str) -> List[Any]:
+        # A field missing from the result reads as NULL in every row, like row.get() did.
+        values = self.columns.get(name)
+        return values if values is not None else [None] * self.num_rows
+
+_NO_ROWS = _ColumnarRows(0, {})
+
+def _arrow_table_to_columns(arrow_table: pa.Table) -> _ColumnarRows:
+    return _ColumnarRows(arrow_table.num_rows, dict(zip(arrow_table.column_names, (_arrow_column_to_json_values(column) for column in arrow_table.columns))))
+
+def _run_report_table_query(bq_client: bigquery.Client, bqstorage_client: Optional[bigquery_storage.BigQueryReadClient], table_placeholder_name: str, final_sql: str, query_params: List[Any]) -> _ColumnarRows:
+    logger.info("Executing BQ Query for table '%s':\n%s", table_placeholder_name, final_sql)
+    query_job = bq_client.query(final_sql, job_config=bigquery.QueryJobConfig(query_parameters=query_params))
+    # The shared Storage Read client streams large results over gRPC; the library keeps small results that already
+    # arrived with the first REST page on that path, so no read session is opened for them.
+    return _arrow_table_to_columns(query_job.result().to_arrow(bqstorage_client=bqstorage_client, create_bqstorage_client=False)) if query_job else _NO_ROWS
+
+class _RunningAggregate:
+    """Online SUM/AVERAGE/MIN/MAX/COUNT/COUNT_DISTINCT over Decimals; keeps no per-row values."""
+    __slots__ = ("sum", "count", "min", "max", "distinct")
+
+    def __init__(self, track_distinct: bool = False):
+        self.sum, self.count, self.min, self.max = Decimal('0'), 0, None, None
+        self.distinct = set() if track_distinct else None
+
+    def add_all(self, values: List[Optional[Decimal]]) -> "_RunningAggregate":
+        # Folds a whole column slice with the C-level sum/min/max/set builtins instead of calling add per value. sum keeps
+        # the same left-to-right order, and min/max return the first of equal values just as the strict comparisons do.
+        present = [value for value in values if value is not None]
+        if not present: return self
+        self.sum = sum(present, self.sum); self.count += len(present)
+        lowest, highest = min(present), max(present)
+        if self.min is None or lowest < self.min: self.min = lowest
+        if self.max is None or highest > self.max: self.max = highest
+        if self.distinct is not None: self.distinct.update(present)
+        return self
+
+    def count_all(self, values: List[Any]) -> "_RunningAggregate":
+        # Counts raw cells without Decimal conversion; only COUNT/COUNT_DISTINCT results are meaningful afterwards.
+        present = [value for value in values if value is not None]
+        self.count += len(present)
+        if self.distinct is not None: self.distinct.update(present)
+        return self
+
+    def result(self, agg_type_str_param: Optional[str]) -> Decimal:
+        if not agg_type_str_param: return Decimal('0')
+        agg_type = agg_type_str_param.upper()
+        if not self.count: return Decimal('0')
+        if agg_type == "SUM": return self.sum
+        elif agg_type == "AVERAGE": return self.sum / Decimal(self.count)
+        elif agg_type == "MIN": return self.min
+        elif agg_type == "MAX": return self.max
+        elif agg_type == "COUNT": return Decimal(self.count)
+        elif agg_type == "COUNT_DISTINCT": return Decimal(len(self.distinct or ()))
+        logger.warning("Unknown aggregation type '%s' received. Returning 0.", agg_type_str_param)
         return Decimal('0')
-    if agg_type == "SUM": return sum(data_list)
-    elif agg_type == "AVERAGE": return sum(data_list) / Decimal(len(data_list)) if data_list else Decimal('0')
-    elif agg_type == "MIN": return min(data_list)
-    elif agg_type == "MAX": return max(data_list)
-    elif agg_type == "COUNT": return Decimal(len(data_list))
-    elif agg_type == "COUNT_DISTINCT": return Decimal(len(set(data_list)))
-    print(f"WARN: Unknown aggregation type '{agg_type_str_param}' received. Returning 0.")
-    return Decimal('0')
+
+def _is_num(value: Any) -> bool:
+    # Native numerics skip the str() coercion entirely; bool is an int subclass but never aggregated.
+    if isinstance(value, (int, float, Decimal)): return not isinstance(value, bool)
+    return isinstance(value, str) and _NUM_RE.match(value) is not None
+
+def _cell_to_decimal(value: Any) -> Optional[Decimal]:
+    return _to_decimal(value) if _is_num(value) else None
+
+def _int_cell_to_decimal(value: Any) -> Optional[Decimal]:
+    return Decimal(value) if type(value) is int else _cell_to_decimal(value)
+
+def _numeric_cell_to_decimal(value: Any) -> Optional[Decimal]:
+    # NUMERIC/BIGNUMERIC cells arrive as canonical decimal text from _arrow_decimal_to_str.
+    if type(value) is str: return Decimal(value) if _NUM_RE.match(value) else None
+    return _cell_to_decimal(value)
+
+_CELL_DECIMAL_CONVERTERS: Dict[str, Callable[[Any], Optional[Decimal]]] = {
+    "INTEGER": _int_cell_to_decimal, "INT64": _int_cell_to_decimal,
+    "NUMERIC": _numeric_cell_to_decimal, "DECIMAL": _numeric_cell_to_decimal, "BIGNUMERIC": _numeric_cell_to_decimal, "BIGDECIMAL": _numeric_cell_to_decimal,
+}
+
+_COUNT_CALCULATION_TYPES = frozenset({CalculationType.COUNT.value, CalculationType.COUNT_DISTINCT.value})
+# Column types whose non-null cells are all numeric and compare equal exactly when their Decimals do: ints, and the
+# normalized decimal text _arrow_decimal_to_str produces. Count-only calculations on them can skip the conversion.
+_COUNT_BY_VALUE_TYPES = frozenset({"INTEGER", "INT64", "NUMERIC", "DECIMAL", "BIGNUMERIC", "BIGDECIMAL"})
+
+def _cell_decimal_converter(field_type: Optional[str]) -> Callable[[Any], Optional[Decimal]]:
+    # Picks the conversion from the column's schema type once; each typed path still falls back for unexpected values.
+    return _CELL_DECIMAL_CONVERTERS.get(str(field_type).upper() if field_type else "", _cell_to_decimal)
 
 # --- Background Task Function for Report Generation ---
 
-def generate_and_save_report_assets(
+def _dry_run_schema(bq_client: bigquery.Client, sql_query: str) -> List[Dict[str, str]]:
+    """Dry-runs sql_query and returns its schema as [{"name", "type", "mode"}], memoized per project + SQL text."""
+    # Only the outer whitespace is trimmed: inner spacing can sit inside string literals or backticked identifiers.
+    cache_key = hashlib.blake2b(f"{bq_client.project}\n{sql_query.strip()}".encode(), digest_size=16).digest()
+    with _dry_run_schema_cache_lock: cached_schema = dry_run_schema_cache.get(cache_key)
+    if cached_schema is not None: return list(cached_schema)
+    dry_run_job = bq_client.query(sql_query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+    schema = [{"name": f.name, "type": str(f.field_type).upper(), "mode": str(f.mode).upper()} for f in dry_run_job.schema] if dry_run_job.schema else []
+    with _dry_run_schema_cache_lock: dry_run_schema_cache[cache_key] = schema
+    return list(schema)
+
+def _field_display_prompt_line(config_item: FieldDisplayConfig) -> str:
+    style_hints = "; ".join(hint for hint in (f"align: {config_item.alignment}" if config_item.alignment else None,
+                                              f"format: {config_item.number_format}" if config_item.number_format else None) if hint)
+    return f"- `{config_item.field_name}` (Styling: {style_hints})\n" if style_hints else f"- `{config_item.field_name}`\n"
+
+async def _dry_run_table_schema(bq_client: bigquery.Client, table_config: DataTableConfig) -> Optional[List[Dict[str, str]]]:
+    async with _dry_run_semaphore:
+        try: return await asyncio.to_thread(_dry_run_schema, bq_client, table_config.sql_query)
+        except Exception as e: logger.warning("Dry run failed for table '%s'. Skipping. Error: %s", table_config.table_placeholder_name, e)
+    return None
+
+async def _dry_run_report_table_schemas(bq_client: bigquery.Client, data_tables: List[DataTableConfig]) -> Dict[str, List[Dict[str, str]]]:
+    # One dry run per table, all in flight at once: the phase costs one BigQuery round-trip instead of one per table.
+    schemas = await asyncio.gather(*(_dry_run_table_schema(bq_client, table_config) for table_config in data_tables))
+    return {table_config.table_placeholder_name: schema for table_config, schema in zip(data_tables, schemas) if schema is not None}
+
+async def generate_and_save_report_assets(
     payload: ReportDefinitionPayload,
     bq_client: bigquery.Client,
     gcs_client: storage.Client,
 ):
     try:
         report_name = payload.report_name
-        print(f"BACKGROUND_TASK: Starting generation for report: '{report_name}'")
-
-        prompt_for_template = payload.prompt
-        all_schemas_for_bq_save = {}
+        logger.info("BACKGROUND_TASK: Starting generation for report: '%s'", report_name)
+
+        # Stable, structural sections go first and the free-text user prompt last, so repeat generations
+        # for the same report share the longest possible leading prefix for Gemini's implicit caching.
+        prompt_sections: List[str] = []
+        # The dry runs and the style-guide image download hit different services, so they run concurrently.
+        all_schemas_for_bq_save, (image_bytes_data, image_mime_type_data) = await asyncio.gather(
+            _dry_run_report_table_schemas(bq_client, payload.data_tables),
+            _fetch_style_guide_image(payload.image_url)
+        )
         
         for table_config in payload.data_tables:
             table_placeholder = table_config.table_placeholder_name
-            
-            schema_from_dry_run_list = []
-            try:
-                # Use the correct bq_client variable passed into the function
-                dry_run_job = bq_client.query(table_config.sql_query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
-                if dry_run_job.schema:
-                    for field in dry_run_job.schema:
-                        field_data = {"name": field.name, "type": str(field.field_type).upper(), "mode": str(field.mode).upper()}
-                        schema_from_dry_run_list.append(field_data)
-                all_schemas_for_bq_save[table_placeholder] = schema_from_dry_run_list
-            except Exception as e:
-                print(f"WARN: Dry run failed for table '{table_placeholder}'. Skipping. Error: {e}")
-                continue
+            if table_placeholder not in all_schemas_for_bq_save: continue
+            schema_from_dry_run_list = all_schemas_for_bq_save[table_placeholder]
 
             schema_for_gemini_prompt_str = ", ".join([f"`{f['name']}` (Type: {f['type']})" for f in schema_from_dry_run_list])
-            prompt_for_template += f"\n\n--- Data Table: `{table_placeholder}` ---\n"
-            prompt_for_template += f"Use the exact placeholder `{{{{TABLE_ROWS_{table_placeholder}}}}}` for this table's body rows.\n"
-            prompt_for_template += f"Schema: {schema_for_gemini_prompt_str}\n"
+            table_section = [f"--- Data Table: `{table_placeholder}` ---\n",
+                             f"Use the exact placeholder `{{{{TABLE_ROWS_{table_placeholder}}}}}` for this table's body rows.\n",
+                             f"Schema: {schema_for_gemini_prompt_str}\n"]
 
             if table_config.field_display_configs:
-                prompt_for_template += "Field Display & Summary Instructions:\n"
-                for config_item in table_config.field_display_configs:
-                    style_hints = [s for s in [f"align: {config_item.alignment}" if config_item.alignment else "", f"format: {config_item.number_format}" if config_item.number_format else ""] if s]
-                    field_info = f"- `{config_item.field_name}`"
-                    if style_hints: field_info += f" (Styling: {'; '.join(style_hints)})"
-                    prompt_for_template += f"{field_info}\n"
-            prompt_for_template += "--- End Data Table ---"
+                table_section.append("Field Display & Summary Instructions:\n")
+                table_section.append("".join(map(_field_display_prompt_line, table_config.field_display_configs)))
+            table_section.append("--- End Data Table ---")
+            prompt_sections.append("".join(table_section))
 
         if payload.look_configs:
-            prompt_for_template += "\n\n--- Chart Image Placeholders ---\nPlease include placeholders for the following charts where you see fit in the layout. Use these exact placeholder names:\n"
-            for look_config in payload.look_configs:
-                prompt_for_template += f"- `{{{{{look_config.placeholder_name}}}}}`\n"
-            prompt_for_template += "--- End Chart Image Placeholders ---"
-        
-        img_response = httpx.get(payload.image_url, timeout=180.0)
-        img_response.raise_for_status()
-        image_bytes_data, image_mime_type_data = img_response.content, img_response.headers.get("Content-Type", "application/octet-stream").lower()
+            prompt_sections.append("--- Chart Image Placeholders ---\nPlease include placeholders for the following charts where you see fit in the layout. Use these exact placeholder names:\n"
+                                   + "".join(f"- `{{{{{look_config.placeholder_name}}}}}`\n" for look_config in payload.look_configs)
+                                   + "--- End Chart Image Placeholders ---")
 
-        html_template_content = generate_html_from_user_pattern(prompt_text=prompt_for_template, image_bytes=image_bytes_data, image_mime_type=image_mime_type_data, system_instruction_text=config.default_system_instruction_text)
+        prompt_sections.append(f"--- Report Design Request ---\n{payload.prompt}")
+        prompt_for_template = "\n\n".join(prompt_sections)
+
+        html_template_content = await generate_html_from_user_pattern(prompt_text=prompt_for_template, image_bytes=image_bytes_data, image_mime_type=image_mime_type_data, system_instruction_text=await _current_system_instruction(), use_cache=not payload.force_regenerate)
         if not html_template_content or not html_template_content.strip():
             html_template_content = "<html><body><p>Error: AI failed to generate valid HTML.</p></body></html>"
 
@@ -781,16 +1261,16 @@ def generate_and_save_report_assets(
         versioned_template_gcs_path_str = f"{base_gcs_folder}/template_v1.html"
         
         bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
-        bucket.blob(versioned_template_gcs_path_str).upload_from_string(html_template_content, content_type='text/html; charset=utf-8')
+        await asyncio.to_thread(_upload_if_changed, bucket.blob(versioned_template_gcs_path_str), html_template_content.encode('utf-8'), 'text/html; charset=utf-8')
         
-        user_attribute_mappings_json_str = json.dumps(payload.user_attribute_mappings or {})
+        user_attribute_mappings_json_str = orjson.dumps(payload.user_attribute_mappings or {}).decode()
         
-        data_tables_json_to_save = json.dumps([dt.model_dump() for dt in payload.data_tables], indent=2)
-        schema_json_to_save = json.dumps(all_schemas_for_bq_save, indent=2)
-        look_configs_json_to_save = json.dumps([lc.model_dump() for lc in payload.look_configs], indent=2) if payload.look_configs else "[]"
-        calculation_row_configs_json_to_save = json.dumps([crc.model_dump(exclude_unset=True) for crc in payload.calculation_row_configs], indent=2) if payload.calculation_row_configs else "[]"
-        subtotal_configs_json_to_save = json.dumps([stc.model_dump() for stc in payload.subtotal_configs], indent=2) if payload.subtotal_configs else "[]"
-        filter_configs_json_to_save = json.dumps([fc.model_dump() for fc in payload.filter_configs], indent=2)
+        data_tables_json_to_save = _DATA_TABLE_CONFIGS_ADAPTER.dump_json(payload.data_tables).decode()
+        schema_json_to_save = orjson.dumps(all_schemas_for_bq_save).decode()
+        look_configs_json_to_save = _LOOK_CONFIGS_ADAPTER.dump_json(payload.look_configs).decode() if payload.look_configs else "[]"
+        calculation_row_configs_json_to_save = _CALCULATION_ROW_CONFIGS_ADAPTER.dump_json(payload.calculation_row_configs, exclude_unset=True).decode() if payload.calculation_row_configs else "[]"
+        subtotal_configs_json_to_save = _SUBTOTAL_CONFIGS_ADAPTER.dump_json(payload.subtotal_configs).decode() if payload.subtotal_configs else "[]"
+        filter_configs_json_to_save = _FILTER_CONFIGS_ADAPTER.dump_json(payload.filter_configs).decode()
 
         table_id = f"`{config.gcp_project_id}.report_printing.report_list`"
         
@@ -817,14 +1297,14 @@ def generate_and_save_report_assets(
             ScalarQueryParameter("subtotal_configs_json", "STRING", subtotal_configs_json_to_save),
             ScalarQueryParameter("user_attribute_mappings_json", "STRING", user_attribute_mappings_json_str),
         ]
-        bq_client.query(merge_sql, job_config=bigquery.QueryJobConfig(query_parameters=merge_params)).result()
+        merge_job = await asyncio.to_thread(bq_client.query, merge_sql, job_config=bigquery.QueryJobConfig(query_parameters=merge_params))
+        await asyncio.to_thread(merge_job.result)
+        await _invalidate_report_definition(report_name)
         
-        print(f"BACKGROUND_TASK: Finished generation for report: '{report_name}'")
+        logger.info("BACKGROUND_TASK: Finished generation for report: '%s'", report_name)
 
     except Exception as e:
-        print(f"FATAL BACKGROUND_TASK ERROR for '{payload.report_name}': {e}")
-        import traceback
-        traceback.print_exc()
+        logger.critical("BACKGROUND_TASK ERROR for '%s': %s", payload.report_name, e, exc_info=True)
 # --- API Endpoints ---
 @app.get("/")
 async def read_root():
@@ -840,40 +1320,39 @@ async def get_public_config():
     tinymce_api_key = os.getenv("TINYMCE_API_KEY")
     
     if not tinymce_api_key:
-        print("WARN: TINYMCE_API_KEY environment variable is not set.")
+        logger.warning("TINYMCE_API_KEY environment variable is not set.")
         return {"tinymce_api_key": None}
         
     return {"tinymce_api_key": tinymce_api_key}
 
-@app.post("/dry_run_sql_for_schema")
+@app.post("/dry_run_sql_for_schema", response_class=ORJSONResponse)
 async def dry_run_sql_for_schema_endpoint(
     payload: SqlQueryPayload, bq_client: bigquery.Client = Depends(get_bigquery_client_dep)
 ):
     try:
-        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-        dry_run_job = bq_client.query(payload.sql_query, job_config=job_config)
-        schema_for_response = [{"name": f.name, "type": str(f.field_type).upper(), "mode": str(f.mode).upper()} for f in dry_run_job.schema] if dry_run_job.schema else []
+        schema_for_response = await asyncio.to_thread(_dry_run_schema, bq_client, payload.sql_query)
         return {"schema": schema_for_response} if schema_for_response else {"schema": [], "message": "Dry run OK but no schema."}
     except Exception as e:
         error_message = str(e); error_details = [err.get('message', 'BQ err') for err in getattr(e, 'errors', [])]; error_message = "; ".join(error_details) if error_details else error_message
-        print(f"ERROR: SQL dry run failed: {error_message} for query: {payload.sql_query}")
+        logger.error("SQL dry run failed: %s for query: %s", error_message, payload.sql_query)
         raise HTTPException(status_code=400, detail=f"SQL dry run failed: {error_message}")
 
-@app.get("/system_instruction")
+@app.get("/system_instruction", response_class=ORJSONResponse)
 async def get_system_instruction_endpoint(storage_client: storage.Client = Depends(get_storage_client_dep)):
-    return {"system_instruction": config.default_system_instruction_text}
+    return {"system_instruction": await _current_system_instruction()}
 
 @app.put("/system_instruction")
 async def update_system_instruction_endpoint(
-    payload: SystemInstructionPayload, storage_client: storage.Client = Depends(get_storage_client_dep)
+    payload: SystemInstructionPayload, background_tasks: BackgroundTasks, storage_client: storage.Client = Depends(get_storage_client_dep)
 ):
     new_instruction_text = payload.system_instruction
     try:
         bucket = storage_client.bucket(config.GCS_BUCKET_NAME); blob = bucket.blob(config.GCS_SYSTEM_INSTRUCTION_PATH)
-        blob.upload_from_string(new_instruction_text, content_type='text/plain; charset=utf-8')
-        config.default_system_instruction_text = new_instruction_text
+        await asyncio.to_thread(_upload_if_changed, blob, new_instruction_text.encode('utf-8'), 'text/plain; charset=utf-8')
+        config.default_system_instruction_text, config.system_instruction_generation = new_instruction_text, blob.generation
+        if config.vertex_ai_initialized: background_tasks.add_task(_refresh_system_instruction_cache)
         return {"message": "System instruction updated successfully."}
-    except Exception as e: print(f"ERROR: Failed to PUT system instruction to GCS: {e}"); raise HTTPException(status_code=500, detail=f"Failed to update system instruction: {str(e)}")
+    except Exception as e: logger.error("Failed to PUT system instruction to GCS: %s", e); raise HTTPException(status_code=500, detail=f"Failed to update system instruction: {str(e)}")
 
 # In app.py, replace the existing discover_template_placeholders function
 
@@ -892,7 +1371,7 @@ async def discover_template_placeholders(
     """
     def_params = [ScalarQueryParameter("report_name_param", "STRING", report_name)]
     try:
-        results = list(bq_client.query(query_def_sql, job_config=bigquery.QueryJobConfig(query_parameters=def_params)).result())
+        results = await asyncio.to_thread(_query_rows, bq_client, query_def_sql, def_params)
         if not results:
             return DiscoverPlaceholdersResponse(report_name=report_name, placeholders=[], template_found=False, error_message=f"Definition not found for '{report_name}'.")
         
@@ -902,10 +1381,10 @@ async def discover_template_placeholders(
             return DiscoverPlaceholdersResponse(report_name=report_name, placeholders=[], template_found=False, error_message=f"Invalid GCS TemplateURL: {template_gcs_path}")
 
         # Load configs to make better suggestions
-        look_configs = json.loads(row.get("LookConfigsJSON") or '[]')
-        filter_configs = json.loads(row.get("FilterConfigsJSON") or '[]')
-        field_display_configs = [FieldDisplayConfig(**item) for item in json.loads(row.get("FieldDisplayConfigsJSON") or '[]')]
-        calculation_rows_configs = [CalculationRowConfig(**item) for item in json.loads(row.get("CalculationRowConfigsJSON") or '[]')]
+        look_configs = orjson.loads(row.get("LookConfigsJSON") or '[]')
+        filter_configs = orjson.loads(row.get("FilterConfigsJSON") or '[]')
+        field_display_configs = _FIELD_DISPLAY_CONFIGS_ADAPTER.validate_json(row.get("FieldDisplayConfigsJSON") or '[]')
+        calculation_rows_configs = _CALCULATION_ROW_CONFIGS_ADAPTER.validate_json(row.get("CalculationRowConfigsJSON") or '[]')
 
     except Exception as e:
         return DiscoverPlaceholdersResponse(report_name=report_name, placeholders=[], template_found=False, error_message=f"Error fetching report definition details: {str(e)}")
@@ -915,12 +1394,18 @@ async def discover_template_placeholders(
         path_parts = template_gcs_path.replace("gs://", "").split("/", 1)
         bucket_name, blob_name = path_parts[0], path_parts[1]
         blob = gcs_client.bucket(bucket_name).blob(blob_name)
-        if not blob.exists():
+        if not await asyncio.to_thread(blob.exists):
             return DiscoverPlaceholdersResponse(report_name=report_name, placeholders=[], template_found=False, error_message=f"Template not found at {template_gcs_path}")
-        html_content = blob.download_as_text(encoding='utf-8')
+        html_content = await asyncio.to_thread(blob.download_as_text, encoding='utf-8')
     except Exception as e:
         return DiscoverPlaceholdersResponse(report_name=report_name, placeholders=[], template_found=False, error_message=f"Error loading template from GCS: {str(e)}")
     
+    # One pass over the field configs maps every TOP_/HEADER_ placeholder they enable; the first config for a key wins.
+    field_placeholder_matches: Dict[str, Tuple[str, str, str]] = {}
+    for fd_config in field_display_configs:
+        if fd_config.include_at_top: field_placeholder_matches.setdefault(f"TOP_{fd_config.field_name}", ("auto_matched_top", "standardize_top", fd_config.field_name))
+        if fd_config.include_in_header: field_placeholder_matches.setdefault(f"HEADER_{fd_config.field_name}", ("auto_matched_header", "standardize_header", fd_config.field_name))
+
     discovered_placeholders_list: List[DiscoveredPlaceholderInfo] = []
     placeholder_keys_found = set(re.findall(r"\{\{([^{}]+?)\}\}", html_content, re.DOTALL))
 
@@ -937,12 +1422,9 @@ async def discover_template_placeholders(
         if key.startswith("TABLE_ROWS_"):
             status, suggestion, matched = "standard_table_rows", None, True
         
-        if not matched:
-            for fd_config in field_display_configs:
-                if key == f"TOP_{fd_config.field_name}" and fd_config.include_at_top:
-                    status, suggestion, matched = "auto_matched_top", PlaceholderMappingSuggestion(map_to_type="standardize_top", map_to_value=fd_config.field_name), True; break
-                if key == f"HEADER_{fd_config.field_name}" and fd_config.include_in_header:
-                    status, suggestion, matched = "auto_matched_header", PlaceholderMappingSuggestion(map_to_type="standardize_header", map_to_value=fd_config.field_name), True; break
+        if not matched and key in field_placeholder_matches:
+            match_status, map_to_type, field_name = field_placeholder_matches[key]
+            status, suggestion, matched = match_status, PlaceholderMappingSuggestion(map_to_type=map_to_type, map_to_value=field_name), True
         if not matched:
             for calc_config in calculation_rows_configs:
                 if key == calc_config.values_placeholder_name:
@@ -970,12 +1452,12 @@ async def upsert_report_definition(
     bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
     gcs_client: storage.Client = Depends(get_storage_client_dep)
 ):
-    print(f"--- Backend Payload Received ---\n{payload.model_dump_json(indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("--- Backend Payload Received ---\n%s", payload.model_dump_json(indent=2))
     """
     Accepts a report definition, validates it quickly, and schedules the slow
     AI generation and asset saving to run in the background. Returns immediately.
     """
-    print(f"INFO: Submission received for report '{payload.report_name}'. Scheduling for background generation.")
+    logger.info("Submission received for report '%s'. Scheduling for background generation.", payload.report_name)
     
     # Add the slow work to a background task, passing all necessary dependencies
     background_tasks.add_task(
@@ -998,18 +1480,14 @@ async def list_report_definitions_endpoint(bq_client: bigquery.Client = Depends(
         FROM `{config.gcp_project_id}.report_printing.report_list` ORDER BY ReportName ASC
     """
     try:
-        results = list(bq_client.query(query).result())
+        results = await asyncio.to_thread(_query_rows, bq_client, query)
         processed_results = []
-        for row_dict_item in [dict(row.items()) for row in results]:
-            for json_field in ['LookConfigsJSON', 'BaseQuerySchemaJSON', 'FieldDisplayConfigsJSON', 'CalculationRowConfigsJSON', 'SubtotalConfigsJSON', 'UserAttributeMappingsJSON', 'UserPlaceholderMappingsJSON']:
-                if row_dict_item.get(json_field) is None:
-                    row_dict_item[json_field] = "{}" if json_field == 'UserAttributeMappingsJSON' else "[]"
-            if row_dict_item.get("LatestTemplateVersion") is None:
-                row_dict_item["LatestTemplateVersion"] = 0
-            try: processed_results.append(ReportDefinitionListItem(**row_dict_item))
-            except Exception as pydantic_error: print(f"ERROR: Pydantic validation for report {row_dict_item.get('ReportName')}: {pydantic_error}. Data: {row_dict_item}"); continue
+        for row in results:
+            row_dict_item = {k: _LIST_ITEM_NULL_DEFAULTS.get(k) if v is None else v for k, v in row.items()}
+            try: processed_results.append(ReportDefinitionListItem.model_validate(row_dict_item))
+            except Exception as pydantic_error: logger.error("Pydantic validation for report %s: %s. Data: %s", row_dict_item.get('ReportName'), pydantic_error, row_dict_item); continue
         return processed_results
-    except Exception as e: print(f"ERROR fetching report definitions: {e}"); raise HTTPException(status_code=500, detail=f"Failed to fetch report definitions: {str(e)}")
+    except Exception as e: logger.error("Fetching report definitions failed: %s", e); raise HTTPException(status_code=500, detail=f"Failed to fetch report definitions: {str(e)}")
 
 @app.delete("/report_definitions/{report_name}", status_code=200)
 async def delete_report_definition(
@@ -1020,7 +1498,7 @@ async def delete_report_definition(
     """
     Deletes a report definition from BigQuery and its associated templates from GCS.
     """
-    print(f"INFO: Received request to DELETE report '{report_name}'.")
+    logger.info("Received request to DELETE report '%s'.", report_name)
 
     # 1. Delete the report definition from BigQuery
     table_id = f"`{config.gcp_project_id}.report_printing.report_list`"
@@ -1028,13 +1506,13 @@ async def delete_report_definition(
     delete_params = [ScalarQueryParameter("report_name", "STRING", report_name)]
     
     try:
-        query_job = bq_client.query(delete_sql, job_config=bigquery.QueryJobConfig(query_parameters=delete_params))
-        query_job.result() # Wait for the query to complete
+        query_job = await asyncio.to_thread(_run_dml, bq_client, delete_sql, delete_params)
         if query_job.num_dml_affected_rows == 0:
             raise HTTPException(status_code=404, detail=f"Report '{report_name}' not found in BigQuery.")
-        print(f"INFO: Successfully deleted report definition '{report_name}' from BigQuery.")
+        await _invalidate_report_definition(report_name)
+        logger.info("Successfully deleted report definition '%s' from BigQuery.", report_name)
     except Exception as e:
-        print(f"ERROR: Failed to delete report '{report_name}' from BigQuery: {e}")
+        logger.error("Failed to delete report '%s' from BigQuery: %s", report_name, e)
         raise HTTPException(status_code=500, detail=f"Failed to delete report from BigQuery: {str(e)}")
 
     # 2. Delete associated report templates from GCS
@@ -1042,20 +1520,16 @@ async def delete_report_definition(
         report_gcs_path_safe = report_name.replace(" ", "_").replace("/", "_").lower()
         prefix_to_delete = f"report_templates/{report_gcs_path_safe}/"
         
-        bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
-        blobs_to_delete = list(bucket.list_blobs(prefix=prefix_to_delete))
+        deleted_count = await asyncio.to_thread(_delete_blobs_with_prefix, gcs_client, config.GCS_BUCKET_NAME, prefix_to_delete)
         
-        if blobs_to_delete:
-            with gcs_client.batch():
-                for blob in blobs_to_delete:
-                    blob.delete()
-            print(f"INFO: Successfully deleted {len(blobs_to_delete)} GCS objects for report '{report_name}' under prefix '{prefix_to_delete}'.")
+        if deleted_count:
+            logger.info("Successfully deleted %s GCS objects for report '%s' under prefix '%s'.", deleted_count, report_name, prefix_to_delete)
         else:
-            print(f"WARN: No GCS objects found to delete for report '{report_name}' under prefix '{prefix_to_delete}'.")
+            logger.warning("No GCS objects found to delete for report '%s' under prefix '%s'.", report_name, prefix_to_delete)
             
     except Exception as e:
         # Don't fail the whole request if GCS cleanup has an issue, but log it.
-        print(f"ERROR: Failed to delete GCS assets for report '{report_name}': {e}")
+        logger.error("Failed to delete GCS assets for report '%s': %s", report_name, e)
         return {"message": f"Report definition '{report_name}' deleted from BigQuery, but an error occurred during GCS cleanup. Please check logs."}
 
     return {"message": f"Report definition '{report_name}' and its associated templates were successfully deleted."}
@@ -1069,13 +1543,13 @@ async def revert_report_template(
     bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
     gcs_client: storage.Client = Depends(get_storage_client_dep)
 ):
-    print(f"INFO: Received request to revert report '{report_name}' to version {payload.target_version}.")
+    logger.info("Received request to revert report '%s' to version %s.", report_name, payload.target_version)
     
     # 1. Fetch current definition to get the latest version number
     query_def_sql = f"SELECT LatestTemplateVersion FROM `{config.gcp_project_id}.report_printing.report_list` WHERE ReportName = @report_name_param"
     def_params = [ScalarQueryParameter("report_name_param", "STRING", report_name)]
     try:
-        results = list(bq_client.query(query_def_sql, job_config=bigquery.QueryJobConfig(query_parameters=def_params)).result())
+        results = await asyncio.to_thread(_query_rows, bq_client, query_def_sql, def_params)
         if not results:
             raise HTTPException(status_code=404, detail=f"Report definition not found for '{report_name}'.")
         
@@ -1104,16 +1578,16 @@ async def revert_report_template(
         bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
         source_blob = bucket.blob(source_blob_name)
 
-        if not source_blob.exists():
+        if not await asyncio.to_thread(source_blob.exists):
             raise HTTPException(status_code=404, detail=f"Source template for version {payload.target_version} not found in GCS at {source_blob_name}.")
 
         # Copy the blob to a new one, creating the new version
-        bucket.copy_blob(source_blob, bucket, destination_blob_name)
-        print(f"INFO: Reverted template. Copied '{source_blob_name}' to '{destination_blob_name}'.")
+        await asyncio.to_thread(bucket.copy_blob, source_blob, bucket, destination_blob_name)
+        logger.info("Reverted template. Copied '%s' to '%s'.", source_blob_name, destination_blob_name)
 
     except Exception as e:
         if isinstance(e, HTTPException): raise e
-        print(f"ERROR: Failed during GCS copy for revert operation: {e}")
+        logger.error("Failed during GCS copy for revert operation: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to copy template in GCS: {str(e)}")
 
     # 3. Update the BigQuery record to point to the new template version
@@ -1130,10 +1604,11 @@ async def revert_report_template(
         ScalarQueryParameter("report_name", "STRING", report_name),
     ]
     try:
-        bq_client.query(update_sql, job_config=bigquery.QueryJobConfig(query_parameters=update_params)).result()
-        print(f"INFO: BigQuery updated for '{report_name}' to point to version {new_version_number}.")
+        await asyncio.to_thread(_run_dml, bq_client, update_sql, update_params)
+        await _invalidate_report_definition(report_name)
+        logger.info("BigQuery updated for '%s' to point to version %s.", report_name, new_version_number)
     except Exception as e:
-        print(f"ERROR: Failed to update BigQuery for reverted template: {e}")
+        logger.error("Failed to update BigQuery for reverted template: %s", e)
         # At this point, GCS has a new file but BQ failed. This is a partial failure state.
         # A more robust system might try to delete the newly created GCS file.
         # For now, we'll return an error indicating the problem.
@@ -1145,18 +1620,18 @@ async def revert_report_template(
 
 # In app.py, after the revert_report_template endpoint
 
-@app.get("/report_definitions/{report_name}/get_html", status_code=200)
+@app.get("/report_definitions/{report_name}/get_html", status_code=200, response_class=ORJSONResponse)
 async def get_report_html(
     report_name: str,
     bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
     gcs_client: storage.Client = Depends(get_storage_client_dep)
 ):
     """Fetches the latest HTML template content for a given report."""
-    print(f"INFO: Request to fetch HTML for report '{report_name}'.")
+    logger.info("Request to fetch HTML for report '%s'.", report_name)
     query_def_sql = f"SELECT TemplateURL FROM `{config.gcp_project_id}.report_printing.report_list` WHERE ReportName = @report_name_param"
     def_params = [ScalarQueryParameter("report_name_param", "STRING", report_name)]
     try:
-        results = list(bq_client.query(query_def_sql, job_config=bigquery.QueryJobConfig(query_parameters=def_params)).result())
+        results = await asyncio.to_thread(_query_rows, bq_client, query_def_sql, def_params)
         if not results or not results[0].get("TemplateURL"):
             raise HTTPException(status_code=404, detail=f"TemplateURL not found for '{report_name}'.")
         
@@ -1165,10 +1640,10 @@ async def get_report_html(
         bucket_name, blob_name = path_parts[0], path_parts[1]
         
         blob = gcs_client.bucket(bucket_name).blob(blob_name)
-        if not blob.exists():
+        if not await asyncio.to_thread(blob.exists):
             raise HTTPException(status_code=404, detail=f"Template file not found at {template_gcs_path}")
         
-        html_content = blob.download_as_text(encoding='utf-8')
+        html_content = await asyncio.to_thread(blob.download_as_text, encoding='utf-8')
         return {"html_content": html_content}
 
     except Exception as e:
@@ -1182,23 +1657,23 @@ async def save_report_html(
     bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
     gcs_client: storage.Client = Depends(get_storage_client_dep)
 ):
-    print(f"--- [SAVE_HTML_DEBUG] Received request for '{report_name}' ---")
+    logger.debug("--- [SAVE_HTML_DEBUG] Received request for '%s' ---", report_name)
 
     # 1. Fetch current version number
     try:
-        print("[SAVE_HTML_DEBUG] Step 1: Fetching current version from BigQuery...")
+        logger.debug("[SAVE_HTML_DEBUG] Step 1: Fetching current version from BigQuery...")
         query_def_sql = f"SELECT LatestTemplateVersion FROM `{config.gcp_project_id}.report_printing.report_list` WHERE ReportName = @report_name_param"
         def_params = [ScalarQueryParameter("report_name_param", "STRING", report_name)]
-        results = list(bq_client.query(query_def_sql, job_config=bigquery.QueryJobConfig(query_parameters=def_params)).result())
+        results = await asyncio.to_thread(_query_rows, bq_client, query_def_sql, def_params)
 
         if not results:
-            print(f"[SAVE_HTML_DEBUG] ERROR: Report name '{report_name}' not found in BigQuery.")
+            logger.error("[SAVE_HTML_DEBUG] ERROR: Report name '%s' not found in BigQuery.", report_name)
             raise HTTPException(status_code=404, detail=f"Report definition not found for '{report_name}'.")
 
         latest_version = results[0].get("LatestTemplateVersion") or 0
-        print(f"[SAVE_HTML_DEBUG] Found current version: {latest_version}")
+        logger.debug("[SAVE_HTML_DEBUG] Found current version: %s", latest_version)
     except Exception as e:
-        print(f"[SAVE_HTML_DEBUG] FATAL ERROR during BigQuery version fetch: {e}")
+        logger.error("[SAVE_HTML_DEBUG] FATAL ERROR during BigQuery version fetch: %s", e)
         raise HTTPException(status_code=500, detail=f"Error fetching current report version: {str(e)}")
 
     # 2. Upload the new HTML content to a new versioned file in GCS
@@ -1209,7 +1684,7 @@ async def save_report_html(
     destination_gcs_uri = f"gs://{config.GCS_BUCKET_NAME}/{destination_blob_name}"
 
     try:
-        print(f"[SAVE_HTML_DEBUG] Step 2: Uploading new version to GCS at '{destination_blob_name}'...")
+        logger.debug("[SAVE_HTML_DEBUG] Step 2: Uploading new version to GCS at '%s'...", destination_blob_name)
         bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
         blob = bucket.blob(destination_blob_name)
 
@@ -1219,17 +1694,17 @@ async def save_report_html(
         # Create a file-like object from the bytes.
         file_obj = io.BytesIO(html_bytes)
         # Use upload_from_file, which handles bytes correctly.
-        blob.upload_from_file(file_obj, content_type='text/html; charset=utf-8')
+        await asyncio.to_thread(blob.upload_from_file, file_obj, content_type='text/html; charset=utf-8')
         # --- END OF FIX ---
 
-        print(f"[SAVE_HTML_DEBUG] GCS upload successful.")
+        logger.debug("[SAVE_HTML_DEBUG] GCS upload successful.")
     except Exception as e:
-        print(f"[SAVE_HTML_DEBUG] FATAL ERROR during GCS upload: {e}")
+        logger.error("[SAVE_HTML_DEBUG] FATAL ERROR during GCS upload: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to save new HTML template to GCS: {str(e)}")
 
     # 3. Update BigQuery to point to the new version
     try:
-        print(f"[SAVE_HTML_DEBUG] Step 3: Updating BigQuery record for new version {new_version_number}...")
+        logger.debug("[SAVE_HTML_DEBUG] Step 3: Updating BigQuery record for new version %s...", new_version_number)
         table_id = f"`{config.gcp_project_id}.report_printing.report_list`"
         update_sql = f"UPDATE {table_id} SET TemplateURL = @new_url, LatestTemplateVersion = @new_version, LastGeneratedTimestamp = CURRENT_TIMESTAMP() WHERE ReportName = @report_name"
         update_params = [
@@ -1237,28 +1712,30 @@ async def save_report_html(
             ScalarQueryParameter("new_version", "INT64", new_version_number),
             ScalarQueryParameter("report_name", "STRING", report_name),
         ]
-        bq_client.query(update_sql, job_config=bigquery.QueryJobConfig(query_parameters=update_params)).result()
-        print(f"[SAVE_HTML_DEBUG] BigQuery update successful.")
+        await asyncio.to_thread(_run_dml, bq_client, update_sql, update_params)
+        await _invalidate_report_definition(report_name)
+        logger.debug("[SAVE_HTML_DEBUG] BigQuery update successful.")
     except Exception as e:
-        print(f"[SAVE_HTML_DEBUG] FATAL ERROR during BigQuery update: {e}")
+        logger.error("[SAVE_HTML_DEBUG] FATAL ERROR during BigQuery update: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to update BigQuery with new template version: {str(e)}")
 
-    print(f"--- [SAVE_HTML_DEBUG] Successfully saved version {new_version_number} for '{report_name}' ---")
+    logger.debug("--- [SAVE_HTML_DEBUG] Successfully saved version %s for '%s' ---", new_version_number, report_name)
     return {"message": f"Successfully saved edits as new version {new_version_number}."}
 
 
-@app.post("/report_definitions/{report_name}/refine_template", response_model=RefinementResponse)
-async def refine_report_template_oneshot(
-    report_name: str, payload: RefinementPayload,
-    bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
-    gcs_client: storage.Client = Depends(get_storage_client_dep),
-    _vertex_ai_init_check: None = Depends(get_vertex_ai_initialized_flag)
-):
-    print(f"INFO: Refining template for report '{report_name}'.")
+class _RefinementContext(NamedTuple):
+    prompt_text: str
+    image_bytes: bytes
+    image_mime_type: str
+    bucket: Any
+    bucket_name: str
+    last_version_number: int
+
+async def _load_refinement_context(report_name: str, payload: RefinementPayload, bq_client: bigquery.Client, gcs_client: storage.Client) -> _RefinementContext:
     query_def_sql = f"SELECT TemplateURL, ScreenshotURL, LatestTemplateVersion FROM `{config.gcp_project_id}.report_printing.report_list` WHERE ReportName = @report_name_param"
     def_params = [ScalarQueryParameter("report_name_param", "STRING", report_name)]
     try:
-        results = list(bq_client.query(query_def_sql, job_config=bigquery.QueryJobConfig(query_parameters=def_params)).result())
+        results = await asyncio.to_thread(_query_rows, bq_client, query_def_sql, def_params)
         if not results: raise HTTPException(status_code=404, detail=f"Report definition '{report_name}' not found.")
         report_def = results[0]
         current_template_gcs_path = report_def.get("TemplateURL")
@@ -1273,8 +1750,8 @@ async def refine_report_template_oneshot(
         bucket_name, current_blob_name = path_parts[0], path_parts[1]
         bucket = gcs_client.bucket(bucket_name)
         template_blob_current = bucket.blob(current_blob_name)
-        if not template_blob_current.exists(): raise HTTPException(status_code=404, detail=f"Template file not found at {current_template_gcs_path}.")
-        current_html_content = template_blob_current.download_as_text(encoding='utf-8')
+        if not await asyncio.to_thread(template_blob_current.exists): raise HTTPException(status_code=404, detail=f"Template file not found at {current_template_gcs_path}.")
+        current_html_content = await asyncio.to_thread(template_blob_current.download_as_text, encoding='utf-8')
     except Exception as e: raise HTTPException(status_code=500, detail=f"Error loading current template from GCS: {str(e)}")
 
     refinement_prompt_for_gemini = f"""
@@ -1298,16 +1775,24 @@ Remember: Output ONLY the raw HTML code. No descriptions, no explanations, no ma
 ALL placeholders for dynamic data MUST use double curly braces, e.g., {{{{YourPlaceholderKey}}}}. Single braces (e.g., {{YourPlaceholderKey}}) are NOT PERMITTED and will not be processed.
     """
     try:
-        async with httpx.AsyncClient(timeout=180.0) as client_httpx:
-            img_response = await client_httpx.get(image_url_for_context); img_response.raise_for_status()
-            image_bytes_data = await img_response.aread()
-            image_mime_type_data = img_response.headers.get("Content-Type", "application/octet-stream").lower()
-            if not image_mime_type_data.startswith("image/"): raise ValueError("Content-Type from URL is not valid for image.")
+        image_bytes_data, image_mime_type_data = await _fetch_style_guide_image(image_url_for_context, require_image=True)
     except Exception as e: raise HTTPException(status_code=400, detail=f"Error fetching style-guide image URL '{image_url_for_context}' for refinement: {str(e)}")
 
-    refined_html_output = generate_html_from_user_pattern(
-        prompt_text=refinement_prompt_for_gemini, image_bytes=image_bytes_data,
-        image_mime_type=image_mime_type_data, system_instruction_text=config.default_system_instruction_text
+    return _RefinementContext(refinement_prompt_for_gemini, image_bytes_data, image_mime_type_data, bucket, bucket_name, last_version_number)
+
+@app.post("/report_definitions/{report_name}/refine_template", response_model=RefinementResponse)
+async def refine_report_template_oneshot(
+    report_name: str, payload: RefinementPayload,
+    bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
+    gcs_client: storage.Client = Depends(get_storage_client_dep),
+    _vertex_ai_init_check: None = Depends(get_vertex_ai_initialized_flag)
+):
+    logger.info("Refining template for report '%s'.", report_name)
+    refinement = await _load_refinement_context(report_name, payload, bq_client, gcs_client)
+    bucket, bucket_name, last_version_number = refinement.bucket, refinement.bucket_name, refinement.last_version_number
+    refined_html_output = await generate_html_from_user_pattern(
+        prompt_text=refinement.prompt_text, image_bytes=refinement.image_bytes,
+        image_mime_type=refinement.image_mime_type, system_instruction_text=await _current_system_instruction(), use_cache=not payload.force_regenerate
     )
     if not refined_html_output or not refined_html_output.strip():
         raise HTTPException(status_code=500, detail="AI failed to generate refined HTML content.")
@@ -1319,7 +1804,7 @@ ALL placeholders for dynamic data MUST use double curly braces, e.g., {{{{YourPl
     new_versioned_gcs_path_str = f"{base_gcs_folder_for_report}/{new_template_filename}"
     try:
         new_template_blob = bucket.blob(new_versioned_gcs_path_str)
-        new_template_blob.upload_from_string(refined_html_output, content_type='text/html; charset=utf-8')
+        await asyncio.to_thread(new_template_blob.upload_from_string, refined_html_output, content_type='text/html; charset=utf-8')
     except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to save refined template v{new_version_number} to GCS: {str(e)}")
 
     table_id = f"`{config.gcp_project_id}.report_printing.report_list`"
@@ -1334,29 +1819,88 @@ ALL placeholders for dynamic data MUST use double curly braces, e.g., {{{{YourPl
         ScalarQueryParameter("report_name", "STRING", report_name)
     ]
     try:
-        job = bq_client.query(update_sql, job_config=bigquery.QueryJobConfig(query_parameters=update_params)); job.result()
-    except Exception as e: print(f"ERROR: Failed to update BigQuery for refined template v{new_version_number} for '{report_name}': {str(e)}")
+        await asyncio.to_thread(_run_dml, bq_client, update_sql, update_params)
+        await _invalidate_report_definition(report_name)
+    except Exception as e: logger.error("Failed to update BigQuery for refined template v%s for '%s': %s", new_version_number, report_name, str(e))
 
     return RefinementResponse(
         report_name=report_name, refined_html_content=refined_html_output,
         new_template_gcs_path=f"gs://{bucket_name}/{new_versioned_gcs_path_str}",
         message=f"Template refined to version {new_version_number} and updated successfully."
     )
-# In app.py, replace the existing execute_report_and_get_url function
 
-@app.post("/execute_report")
-async def execute_report_and_get_url(
-    payload: ExecuteReportPayload,
+@app.post("/report_definitions/{report_name}/refine_template/stream")
+async def stream_refined_report_template(
+    report_name: str, payload: RefinementPayload,
     bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
     gcs_client: storage.Client = Depends(get_storage_client_dep),
-    looker_sdk: methods40.Looker40SDK = Depends(get_looker_sdk_client_dep)
+    _vertex_ai_init_check: None = Depends(get_vertex_ai_initialized_flag)
 ):
-    global config
-    report_definition_name = payload.report_definition_name
-    filter_criteria_json_str = payload.filter_criteria_json
-    print(f"INFO: POST /execute_report for '{report_definition_name}'. Filters JSON: {filter_criteria_json_str}")
+    """Streams a refined template preview as Gemini produces it. Nothing is persisted; save it via /save_html."""
+    logger.info("Streaming template refinement preview for report '%s'.", report_name)
+    refinement = await _load_refinement_context(report_name, payload, bq_client, gcs_client)
+    html_chunks = _strip_code_fence_stream(_stream_gemini_text(refinement.prompt_text, refinement.image_bytes, refinement.image_mime_type, await _current_system_instruction()))
+    # Await up to the first non-blank chunk here so model errors still surface as HTTP errors rather than a truncated 200;
+    # leading blank chunks (e.g. the newline after a ```html fence) are held back and sent with it.
+    leading_chunks: List[str] = []
+    async for chunk in html_chunks:
+        leading_chunks.append(chunk)
+        if chunk.strip(): break
+    else: raise HTTPException(status_code=500, detail="AI failed to generate refined HTML content.")
+
+    async def refined_html_stream():
+        yield "".join(leading_chunks)
+        async for chunk in html_chunks: yield chunk
+    return StreamingResponse(refined_html_stream(), media_type="text/html; charset=utf-8", headers={"Cache-Control": "no-store"})
+# In app.py, replace the existing execute_report_and_get_url function
 
-    # --- 1. Fetch and Parse Report Definition ---
+class _CalculationRowPlan(NamedTuple):
+    values_placeholder_name: str
+    # (target_field_name, calculation type, formatter, opening <td>) per calculated value, in template order.
+    cell_plan: Tuple[Tuple[str, str, Callable[..., str], str], ...]
+
+def _calculation_row_plans(calculation_row_configs: List[CalculationRowConfig], schema_type_map: Dict[str, str]) -> Tuple[_CalculationRowPlan, ...]:
+    # Calculation rows summarise the first data table, so its schema types pick the formatters.
+    return tuple(_CalculationRowPlan(calc_config.values_placeholder_name, tuple(
+        (value_conf.target_field_name, value_conf.calculation_type.value,
+         _value_formatter(value_conf.number_format, schema_type_map.get(value_conf.target_field_name), memoize=True),
+         f"<td style='text-align: {value_conf.alignment or 'right'};'>")
+        for value_conf in calc_config.calculated_values)) for calc_config in calculation_row_configs)
+
+class _CompiledReportDefinition(NamedTuple):
+    token: Optional[str]
+    html_template_gcs_path: str
+    look_configs_json: Optional[str]
+    calculation_row_plans: Tuple[_CalculationRowPlan, ...]
+    filter_configs: List[Dict[str, Any]]
+    table_layouts: Tuple[_TableLayout, ...]
+    template_html: Optional[str] = None
+
+def _report_definition_redis_key(report_name: str) -> str: return f"reportdef:{report_name}"
+
+async def _report_definition_token(report_name: str) -> Optional[str]:
+    # Changes whenever any worker writes the definition; "" means Redis could not be asked, which never matches.
+    if config.redis_client is None: return None
+    try: token = await config.redis_client.get(_report_definition_redis_key(report_name))
+    except Exception as e:
+        logger.warning("Could not read definition token for '%s' from Redis: %s", report_name, e); return ""
+    return token.decode('utf-8') if token is not None else None
+
+async def _get_cached_report_definition(report_name: str) -> Optional[_CompiledReportDefinition]:
+    # Without Redis a write on another worker could not reach this one, so nothing is trusted.
+    if config.redis_client is None: return None
+    cached = report_definition_cache.get(report_name)
+    if cached is None: return None
+    return cached if cached.token != "" and cached.token == await _report_definition_token(report_name) else None
+
+async def _invalidate_report_definition(report_name: str) -> None:
+    report_definition_cache.pop(report_name, None)
+    if config.redis_client is None: return
+    # Outlives every cache entry, so a worker can never see the token vanish and match an entry from before this write.
+    try: await config.redis_client.set(_report_definition_redis_key(report_name), uuid.uuid4().hex, ex=2 * config.REPORT_DEFINITION_CACHE_TTL_SECONDS)
+    except Exception as e: logger.warning("Could not publish definition change for '%s' to Redis: %s", report_name, e)
+
+def _fetch_report_definition_row(bq_client: bigquery.Client, report_definition_name: str):
     # Reverted to not select HeaderText or FooterText
     query_def_sql_exec = f"""
         SELECT SQL, TemplateURL, UserAttributeMappingsJSON, BaseQuerySchemaJSON, FilterConfigsJSON,
@@ -1364,51 +1908,62 @@ async def execute_report_and_get_url(
         FROM `{config.gcp_project_id}.report_printing.report_list` WHERE ReportName = @report_name_param
     """
     def_params_exec = [ScalarQueryParameter("report_name_param", "STRING", report_definition_name)]
-    try:
-        results_exec = list(bq_client.query(query_def_sql_exec, job_config=bigquery.QueryJobConfig(query_parameters=def_params_exec)).result())
-        if not results_exec:
-            raise HTTPException(status_code=404, detail=f"Report definition '{report_definition_name}' not found.")
-        
-        row_exec = results_exec[0]
-        data_tables_json = row_exec.get("SQL")
-        html_template_gcs_path = row_exec.get("TemplateURL")
-        look_configs_json = row_exec.get("LookConfigsJSON")
-        all_schemas = json.loads(row_exec.get("BaseQuerySchemaJSON") or '{}')
-        parsed_calculation_row_configs = [CalculationRowConfig(**item) for item in json.loads(row_exec.get("CalculationRowConfigsJSON") or '[]')]
-        parsed_filter_configs = json.loads(row_exec.get("FilterConfigsJSON") or '[]')
+    results_exec = _query_rows(bq_client, query_def_sql_exec, def_params_exec)
+    return results_exec[0] if results_exec else None
 
-        if not data_tables_json or not html_template_gcs_path:
-            raise HTTPException(status_code=404, detail="Report definition is incomplete. Missing Data Tables or Template URL.")
-
-        data_tables_configs = [DataTableConfig(**dt) for dt in json.loads(data_tables_json)]
+@app.post("/execute_report", response_class=ORJSONResponse)
+async def execute_report_and_get_url(
+    payload: ExecuteReportPayload,
+    bq_client: bigquery.Client = Depends(get_bigquery_client_dep),
+    gcs_client: storage.Client = Depends(get_storage_client_dep),
+    looker_sdk: methods40.Looker40SDK = Depends(get_looker_sdk_client_dep),
+    bqstorage_client: Optional[bigquery_storage.BigQueryReadClient] = Depends(get_bqstorage_client_dep)
+):
+    global config
+    report_definition_name = payload.report_definition_name
+    filter_criteria_json_str = payload.filter_criteria_json
+    logger.info("POST /execute_report for '%s'. Filters JSON: %s", report_definition_name, filter_criteria_json_str)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching or parsing report definition '{report_definition_name}': {str(e)}")
+    # --- 1. Fetch and Parse Report Definition ---
+    compiled_definition = await _get_cached_report_definition(report_definition_name)
+    if compiled_definition is None:
+        try:
+            # Read before the row so a write that lands mid-fetch leaves this entry already stale.
+            definition_token = await _report_definition_token(report_definition_name)
+            row_exec = await asyncio.to_thread(_fetch_report_definition_row, bq_client, report_definition_name)
+            if row_exec is None:
+                raise HTTPException(status_code=404, detail=f"Report definition '{report_definition_name}' not found.")
+
+            data_tables_json = row_exec.get("SQL")
+            html_template_gcs_path = row_exec.get("TemplateURL")
+            if not data_tables_json or not html_template_gcs_path:
+                raise HTTPException(status_code=404, detail="Report definition is incomplete. Missing Data Tables or Template URL.")
+
+            table_layouts = _compile_table_layouts(data_tables_json, row_exec.get("BaseQuerySchemaJSON") or '{}')
+            compiled_definition = _CompiledReportDefinition(
+                definition_token, html_template_gcs_path, row_exec.get("LookConfigsJSON"),
+                _calculation_row_plans(_CALCULATION_ROW_CONFIGS_ADAPTER.validate_json(row_exec.get("CalculationRowConfigsJSON") or '[]'),
+                                       next((layout.schema_type_map for layout in table_layouts if layout.table_idx == 0), {})),
+                orjson.loads(row_exec.get("FilterConfigsJSON") or '[]'), table_layouts)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching or parsing report definition '{report_definition_name}': {str(e)}")
 
-    try:
-        path_parts = html_template_gcs_path.replace("gs://", "").split("/", 1)
-        blob = gcs_client.bucket(path_parts[0]).blob(path_parts[1])
-        populated_html = blob.download_as_text(encoding='utf-8') if blob.exists() else f"<html><body>Template not found at {html_template_gcs_path}</body></html>"
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to load HTML template: {str(e)}")
+    html_template_gcs_path, look_configs_json = compiled_definition.html_template_gcs_path, compiled_definition.look_configs_json
+    calculation_row_plans, parsed_filter_configs = compiled_definition.calculation_row_plans, compiled_definition.filter_configs
+    table_layouts = compiled_definition.table_layouts
 
-    # --- 2. Build Filter Logic & Replace Filter Placeholders ---
+    # --- 2. Build Filter Logic ---
     try:
-        looker_filters_payload_exec = json.loads(filter_criteria_json_str or "{}")
+        looker_filters_payload_exec = orjson.loads(filter_criteria_json_str or "{}")
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON for filter_criteria: {str(e)}")
     
     user_filter_values = looker_filters_payload_exec.get("dynamic_filters", {})
-    for f_config in parsed_filter_configs:
-        filter_key = f_config.get("ui_filter_key")
-        if filter_key:
-            placeholder_tag = f"{{{{FILTER_{filter_key}}}}}"
-            replacement_value = str(user_filter_values.get(filter_key, ""))
-            populated_html = populated_html.replace(placeholder_tag, replacement_value)
 
     # Header/Footer text replacement logic is removed.
 
-    current_query_params_for_bq_exec = []; param_idx_exec = 0
+    # Parameters are planned as plain (name, type, value) tuples and instantiated in one batch after the loop.
+    scalar_plan, array_plan = [], []; param_idx_exec = 0
     base_conditions = []
     for filter_key, val_str_list in user_filter_values.items():
         bq_col, op_conf = None, None
@@ -1420,164 +1975,163 @@ async def execute_report_and_get_url(
             try:
                 p_name = f"df_p_{param_idx_exec}"; param_idx_exec += 1
                 bq_type, typed_val = get_bq_param_type_and_value(str(val_str_list), bq_col, op_conf["param_type_hint"])
-                if op_conf["param_type_hint"] != "NONE":
-                    base_conditions.append({'col': bq_col, 'op': op_conf['op'], 'p_name': p_name})
-                    current_query_params_for_bq_exec.append(ScalarQueryParameter(p_name, bq_type, typed_val))
+                if op_conf["param_type_hint"] == "NONE":
+                    base_conditions.append({'col': bq_col, 'sql': op_conf['op']})
+                elif bq_type.endswith("_RANGE"):
+                    scalar_plan.append((f"{p_name}_start", bq_type[:-len("_RANGE")], typed_val[0]))
+                    scalar_plan.append((f"{p_name}_end", bq_type[:-len("_RANGE")], typed_val[1]))
+                    base_conditions.append({'col': bq_col, 'sql': f"BETWEEN @{p_name}_start AND @{p_name}_end"})
+                elif isinstance(typed_val, list):
+                    array_plan.append((p_name, bq_type, typed_val))
+                    base_conditions.append({'col': bq_col, 'sql': f"IN UNNEST(@{p_name})"})
                 else:
-                    base_conditions.append({'col': bq_col, 'op': op_conf['op'], 'p_name': None})
-            except ValueError as ve: print(f"WARN: Skipping Dyn filter '{bq_col}': {ve}")
-
-    # --- 3. Loop through each Data Table to execute and render ---
-    for table_idx, table_config in enumerate(data_tables_configs):
-        table_placeholder_name = table_config.table_placeholder_name
-        base_sql_query = table_config.sql_query
-        field_configs_list = table_config.field_display_configs
-        
-        if not table_placeholder_name or not base_sql_query: continue
-            
-        field_configs_map = {fc.field_name: fc for fc in field_configs_list}
-        schema_for_table = all_schemas.get(table_placeholder_name, [])
-        if not schema_for_table:
-            print(f"WARN: No schema found for data table '{table_placeholder_name}' in BaseQuerySchemaJSON. Skipping.")
-            continue
-            
-        schema_type_map = {f['name']: f['type'] for f in schema_for_table}
-        body_field_names_in_order = [f['name'] for f in schema_for_table if (field_configs_map.get(f['name']) or FieldDisplayConfig(field_name=f['name'])).include_in_body]
-        
-        final_sql = base_sql_query
+                    scalar_plan.append((p_name, bq_type, typed_val))
+                    base_conditions.append({'col': bq_col, 'sql': f"{op_conf['op']} @{p_name}"})
+            except ValueError as ve: logger.warning("Skipping Dyn filter '%s': %s", bq_col, ve)
+    current_query_params_for_bq_exec = [ScalarQueryParameter(n, t, v) for n, t, v in scalar_plan] + [ArrayQueryParameter(n, t, v) for n, t, v in array_plan]
+
+    # --- 3. Plan each Data Table's query ---
+    calc_target_fields = {target_field_name for calc_plan in calculation_row_plans for target_field_name, *_ in calc_plan.cell_plan}
+    table_plans = []
+    for layout in table_layouts:
+        final_sql = layout.sql_query
         table_conditions = []
         for cond in base_conditions:
-            if cond['col'] in schema_type_map:
-                if cond['p_name']: table_conditions.append(f"`{cond['col']}` {cond['op']} @{cond['p_name']}")
-                else: table_conditions.append(f"`{cond['col']}` {cond['op']}")
+            if cond['col'] in layout.schema_type_map: table_conditions.append(f"`{cond['col']}` {cond['sql']}")
         
         if table_conditions:
             conditions_sql_segment = " AND ".join(table_conditions)
-            if " where " in final_sql.lower(): final_sql += f" AND ({conditions_sql_segment})"
-            else: final_sql = f"SELECT * FROM ({final_sql}) AS GenAIReportSubquery WHERE {conditions_sql_segment}"
+            where_match = _WHERE_RE.search(final_sql)
+            # Appending is only safe when nothing follows the WHERE clause; otherwise wrap the query.
+            if where_match and not _TRAILING_CLAUSE_RE.search(final_sql, where_match.end()): final_sql += f" AND ({conditions_sql_segment})"
+            else:
+                # The wrapper only needs to return what rendering reads, so BigQuery can prune the other columns.
+                needed_fields = {*layout.body_field_names_in_order, *layout.summary_plan.agg_fields, layout.group_by_field}
+                if layout.table_idx == 0: needed_fields |= calc_target_fields
+                projected = [f"`{f}`" for f in layout.schema_type_map if f in needed_fields]
+                projection = ", ".join(projected) if projected and len(projected) < len(layout.schema_type_map) else "*"
+                final_sql = f"SELECT {projection} FROM ({final_sql}) AS GenAIReportSubquery WHERE {conditions_sql_segment}"
+
+        table_plans.append((layout, final_sql))
+
+    # --- 4. Run the table queries concurrently with the template download ---
+    # The two I/O paths are independent, so latency becomes max(bq, gcs) instead of their sum.
+    cached_template_html = compiled_definition.template_html
+    template_result, *table_rows_results = await asyncio.gather(
+        asyncio.sleep(0, cached_template_html) if cached_template_html is not None else asyncio.to_thread(_download_report_template, gcs_client, html_template_gcs_path),
+        *[asyncio.to_thread(_run_report_table_query, bq_client, bqstorage_client, layout.table_placeholder_name, final_sql, current_query_params_for_bq_exec) for layout, final_sql in table_plans],
+        return_exceptions=True
+    )
+    if isinstance(template_result, BaseException):
+        raise HTTPException(status_code=500, detail=f"Failed to load HTML template: {str(template_result)}")
+    if template_result is None:
+        template_result = f"<html><body>Template not found at {html_template_gcs_path}</body></html>"
+    elif cached_template_html is None and config.redis_client is not None:
+        report_definition_cache[report_definition_name] = compiled_definition._replace(template_html=template_result)
+    # Placeholder values are collected here and substituted in one pass at the end; the first value set for a name wins.
+    substitutions: Dict[str, str] = {}
+    look_configs = orjson.loads(look_configs_json) if look_configs_json else []
+    look_placeholder_names = tuple(str(name) for name in filter(None, (lc.get('placeholder_name') or lc.get('placeholderName') for lc in look_configs)))
+    compiled_template = _compile_report_template(template_result, look_placeholder_names)
 
-        try:
-            print(f"INFO: Executing BQ Query for table '{table_placeholder_name}':\n{final_sql}")
-            job_cfg_exec = bigquery.QueryJobConfig(query_parameters=current_query_params_for_bq_exec)
-            query_job = bq_client.query(final_sql, job_config=job_cfg_exec)
-            data_rows_list = [convert_row_to_json_serializable(row) for row in query_job.result()] if query_job else []
-        except Exception as e:
-            print(f"ERROR: BQ execution for table '{table_placeholder_name}': {str(e)}")
-            data_rows_list = []
-
-        table_rows_html_str = ""
-        group_by_field = next((fc.field_name for fc in field_configs_list if fc.group_summary_action in ['SUBTOTAL_ONLY', 'SUBTOTAL_AND_GRAND_TOTAL']), None)
-        agg_fields = {fc.field_name: fc.numeric_aggregation for fc in field_configs_list if fc.numeric_aggregation and schema_type_map.get(fc.field_name) in NUMERIC_TYPES_FOR_AGG}
-        grand_total_needed = any(fc.group_summary_action in ['GRAND_TOTAL_ONLY', 'SUBTOTAL_AND_GRAND_TOTAL'] for fc in field_configs_list)
-        grand_total_accumulators = {f: [] for f in agg_fields}
+    for f_config in parsed_filter_configs:
+        filter_key = f_config.get("ui_filter_key")
+        if filter_key: substitutions.setdefault(f"FILTER_{filter_key}", _noop_format(user_filter_values.get(filter_key, "")))
+
+    # --- 5. Render each Data Table ---
+    for (layout, final_sql), table_rows in zip(table_plans, table_rows_results):
+        table_idx, table_placeholder_name = layout.table_idx, layout.table_placeholder_name
+        schema_type_map, body_field_names_in_order = layout.schema_type_map, layout.body_field_names_in_order
+        if isinstance(table_rows, BaseException):
+            logger.error("BQ execution for table '%s': %s", table_placeholder_name, str(table_rows))
+            table_rows = _NO_ROWS
+
+        table_row_parts: List[str] = []
+        group_by_field, render_row = layout.group_by_field, layout.render_row
+        summary_plan = layout.summary_plan
+        agg_fields, grand_total_needed = summary_plan.agg_fields, summary_plan.grand_total_needed
+        subtotal_row_prefix, grand_total_row_prefix, summary_row_html = summary_plan.subtotal_row_prefix, summary_plan.grand_total_row_prefix, summary_plan.render_summary_row
+        num_rows = table_rows.num_rows
+
+        def aggregate_rows(start: int, end: int) -> Dict[str, _RunningAggregate]:
+            return {f: _RunningAggregate(f in summary_plan.distinct_agg_fields).add_all(values[start:end]) for f, values in agg_columns.items()}
         
-        if not data_rows_list:
+        if not num_rows:
             colspan = len(body_field_names_in_order) or 1
-            table_rows_html_str = f"<tr><td colspan='{colspan}' style='text-align:center; padding: 20px;'>No data returned for this table.</td></tr>"
+            table_row_parts.append(f"<tr><td colspan='{colspan}' style='text-align:center; padding: 20px;'>No data returned for this table.</td></tr>")
         else:
-            current_group_val, subtotal_accumulators = None, {f: [] for f in agg_fields}
-
-            for row_idx, row_data in enumerate(data_rows_list):
-                is_first_row_of_group = False
-                if group_by_field:
-                    new_group_val = row_data.get(group_by_field)
-                    is_first_row_of_group = current_group_val != new_group_val
-                    if row_idx > 0 and is_first_row_of_group:
-                        subtotal_html = f"<tr class='subtotal-row' style='font-weight: bold; background-color: #f2f2f2;'><td style='text-align: right;' colspan='{len(body_field_names_in_order) - len(agg_fields)}'>Subtotal for {current_group_val}:</td>"
-                        for field_name in body_field_names_in_order:
-                            if field_name in agg_fields:
-                                result = calculate_aggregate([Decimal(v) for v in subtotal_accumulators[field_name]], agg_fields[field_name])
-                                config = field_configs_map.get(field_name) or FieldDisplayConfig(field_name=field_name)
-                                subtotal_html += f"<td style='text-align: {config.alignment or 'right'};'>{format_value(result, config.number_format, schema_type_map.get(field_name))}</td>"
-                        subtotal_html += "</tr>"
-                        table_rows_html_str += subtotal_html
-                        subtotal_accumulators = {f: [] for f in agg_fields}
-                    current_group_val = new_group_val
-                
-                for field, agg_type in agg_fields.items():
-                    val = row_data.get(field)
-                    if val is not None:
-                        try:
-                            dec_val = Decimal(str(val))
-                            if group_by_field: subtotal_accumulators[field].append(dec_val)
-                            if grand_total_needed: grand_total_accumulators[field].append(dec_val)
-                        except InvalidOperation: pass
-
-                row_html_item = "<tr>"
-                for col_idx, header_key in enumerate(body_field_names_in_order):
-                    field_config = field_configs_map.get(header_key) or FieldDisplayConfig(field_name=header_key)
-                    cell_value = row_data.get(header_key)
-                    formatted_val = format_value(cell_value, field_config.number_format, schema_type_map.get(header_key, "STRING"))
-                    
-                    if group_by_field and header_key == group_by_field and field_config.repeat_group_value == 'SHOW_ON_CHANGE' and not is_first_row_of_group:
-                        formatted_val = ''
-
-                    align_val = field_config.alignment or "left"
-                    row_html_item += f"  <td style='text-align: {align_val};'>{formatted_val}</td>"
-                row_html_item += "</tr>\n"
-                table_rows_html_str += row_html_item
-
-            if group_by_field and data_rows_list:
-                subtotal_html = f"<tr class='subtotal-row' style='font-weight: bold; background-color: #f2f2f2;'><td style='text-align: right;' colspan='{len(body_field_names_in_order) - len(agg_fields)}'>Subtotal for {current_group_val}:</td>"
-                for field_name in body_field_names_in_order:
-                    if field_name in agg_fields:
-                        result = calculate_aggregate([Decimal(v) for v in subtotal_accumulators[field_name]], agg_fields[field_name])
-                        config = field_configs_map.get(field_name) or FieldDisplayConfig(field_name=field_name)
-                        subtotal_html += f"<td style='text-align: {config.alignment or 'right'};'>{format_value(result, config.number_format, schema_type_map.get(field_name))}</td>"
-                subtotal_html += "</tr>"
-                table_rows_html_str += subtotal_html
-
-            if grand_total_needed and data_rows_list:
-                gt_html = f"<tr class='grand-total-row' style='font-weight: bold; border-top: 2px solid black; background-color: #e0e0e0;'><td style='text-align: right;' colspan='{len(body_field_names_in_order) - len(agg_fields)}'>Grand Total:</td>"
-                for field_name in body_field_names_in_order:
-                    if field_name in agg_fields:
-                        result = calculate_aggregate([Decimal(v) for v in grand_total_accumulators[field_name]], agg_fields[field_name])
-                        config = field_configs_map.get(field_name) or FieldDisplayConfig(field_name=field_name)
-                        gt_html += f"<td style='text-align: {config.alignment or 'right'};'>{format_value(result, config.number_format, schema_type_map.get(field_name))}</td>"
-                gt_html += "</tr>"
-                table_rows_html_str += gt_html
-
-            if table_idx == 0 and parsed_calculation_row_configs:
-                for calc_config in parsed_calculation_row_configs:
-                    placeholder_in_template_regex = r"\{\{\s*" + re.escape(calc_config.values_placeholder_name) + r"\s*\}\}"
-                    if re.search(placeholder_in_template_regex, populated_html):
-                        td_outputs = ""
-                        for value_conf in calc_config.calculated_values:
-                            data_to_agg = [Decimal(str(r.get(value_conf.target_field_name, 0))) for r in data_rows_list if r.get(value_conf.target_field_name) is not None]
-                            agg_result = calculate_aggregate(data_to_agg, value_conf.calculation_type.value)
-                            agg_html = format_value(agg_result, value_conf.number_format, schema_type_map.get(value_conf.target_field_name))
-                            td_outputs += f"<td style='text-align: {value_conf.alignment or 'right'};'>{agg_html}</td>"
-                        populated_html = re.sub(placeholder_in_template_regex, td_outputs, populated_html)
-
-        placeholder_to_replace = f"{{{{TABLE_ROWS_{table_placeholder_name}}}}}"
-        populated_html = populated_html.replace(placeholder_to_replace, table_rows_html_str)
-
-    # --- 4. Process Looks and Finalize Report ---
-    if look_configs_json:
-        look_configs = json.loads(look_configs_json)
+            append_row_html = table_row_parts.append
+            # Each aggregated column is converted to Decimal once; subtotals and the grand total then fold slices of it.
+            agg_columns = {f: [to_decimal(v) for v in table_rows.column(f)] for f, to_decimal in summary_plan.agg_cell_plan} if group_by_field or grand_total_needed else {}
+            body_columns = [table_rows.column(f) for f in body_field_names_in_order]
+            body_rows = zip(*body_columns) if body_columns else itertools.repeat((), num_rows)
+
+            if group_by_field:
+                group_values, group_start = table_rows.column(group_by_field), 0
+                # Group breaks closed by num_rows, so the last group is flushed by the same branch as every other one.
+                group_bounds = [i for i in range(1, num_rows) if group_values[i] != group_values[i - 1]]
+                group_bounds.append(num_rows)
+                for group_end in group_bounds:
+                    group_val, group_body_rows = group_values[group_start], itertools.islice(body_rows, group_end - group_start)
+                    # A leading NULL group never counted as a change of value, so its first row stays blanked as before.
+                    append_row_html(render_row(next(group_body_rows), group_start > 0 or group_val is not None))
+                    for row_values in group_body_rows: append_row_html(render_row(row_values, False))
+                    append_row_html(summary_row_html(subtotal_row_prefix.format(str(group_val).translate(_HTML_ESCAPE_TABLE)), aggregate_rows(group_start, group_end)))
+                    group_start = group_end
+            else:
+                for row_values in body_rows: append_row_html(render_row(row_values, False))
+
+            if grand_total_needed:
+                append_row_html(summary_row_html(grand_total_row_prefix, aggregate_rows(0, num_rows)))
+
+            if table_idx == 0 and calculation_row_plans:
+                calc_rows_in_template = [calc_plan for calc_plan in calculation_row_plans if calc_plan.values_placeholder_name in compiled_template.names]
+
+                # Each target column is folded once, reusing the Decimal column already built for subtotals when there is one.
+                calc_accumulators: Dict[str, _RunningAggregate] = {}
+                count_only_targets: Dict[str, bool] = {}
+                for calc_plan in calc_rows_in_template:
+                    for target_field_name, calculation_type, _, _ in calc_plan.cell_plan:
+                        acc = calc_accumulators.setdefault(target_field_name, _RunningAggregate())
+                        if calculation_type == CalculationType.COUNT_DISTINCT.value and acc.distinct is None: acc.distinct = set()
+                        count_only_targets[target_field_name] = count_only_targets.get(target_field_name, True) and calculation_type in _COUNT_CALCULATION_TYPES
+                for target_field_name, acc in calc_accumulators.items():
+                    decimal_values = agg_columns.get(target_field_name)
+                    if decimal_values is not None: acc.add_all(decimal_values)
+                    elif count_only_targets[target_field_name] and str(schema_type_map.get(target_field_name)).upper() in _COUNT_BY_VALUE_TYPES:
+                        acc.count_all(table_rows.column(target_field_name))
+                    else: acc.add_all(list(map(_cell_decimal_converter(schema_type_map.get(target_field_name)), table_rows.column(target_field_name))))
+
+                for calc_plan in calc_rows_in_template:
+                    td_outputs = "".join([cell_open + formatter(calc_accumulators[f].result(calculation_type)) + "</td>" for f, calculation_type, formatter, cell_open in calc_plan.cell_plan])
+                    substitutions.setdefault(calc_plan.values_placeholder_name, td_outputs)
+
+        substitutions.setdefault(f"TABLE_ROWS_{table_placeholder_name}", "".join(table_row_parts))
+
+    # --- 6. Process Looks and Finalize Report ---
+    if look_configs:
         for look_config in look_configs:
             look_id = look_config.get('look_id') or look_config.get('lookId')
             placeholder_name = look_config.get('placeholder_name') or look_config.get('placeholderName')
 
             if not look_id or not placeholder_name:
-                print(f"WARN: Skipping a look configuration due to missing 'look_id' or 'placeholder_name'. Config: {look_config}")
+                logger.warning("Skipping a look configuration due to missing 'look_id' or 'placeholder_name'. Config: %s", look_config)
                 continue
             
             try:
                 look_filters_for_sdk = {}
+                look_id_str = str(look_id)
                 for fc in parsed_filter_configs:
-                    ui_key = fc.get('ui_filter_key')
-                    if ui_key in user_filter_values:
-                        for target in fc.get('targets', []):
-                            if target.get('target_type') == 'LOOK' and str(target.get('target_id')) == str(look_id):
-                                look_filter_name = target.get('target_field_name')
-                                filter_value = user_filter_values[ui_key]
-                                if look_filter_name and filter_value is not None:
-                                    look_filters_for_sdk[look_filter_name] = str(filter_value)
+                    # One lookup per filter; a missing key and an explicit null are both skipped.
+                    if (filter_value := user_filter_values.get(fc.get('ui_filter_key'))) is None: continue
+                    for target in fc.get('targets', []):
+                        if target.get('target_type') == 'LOOK' and str(target.get('target_id')) == look_id_str:
+                            look_filter_name = target.get('target_field_name')
+                            if look_filter_name: look_filters_for_sdk[look_filter_name] = str(filter_value)
                 
-                print(f"INFO: Rendering Look ID {look_id} with new filters: {look_filters_for_sdk}")
+                logger.info("Rendering Look ID %s with new filters: %s", look_id, look_filters_for_sdk)
 
-                look = looker_sdk.look(look_id=str(look_id))
+                look = await asyncio.to_thread(looker_sdk.look, look_id=str(look_id))
                 if not look or not look.query:
                     raise Exception(f"Look {look_id} or its query could not be fetched.")
 
@@ -1585,7 +2139,8 @@ async def execute_report_and_get_url(
                 if not new_query.filters: new_query.filters = {}
                 for f_key, f_val in look_filters_for_sdk.items(): new_query.filters[f_key] = f_val
 
-                image_bytes = looker_sdk.run_inline_query(
+                image_bytes = await asyncio.to_thread(
+                    looker_sdk.run_inline_query,
                     result_format="png",
                     body=models40.WriteQuery(
                         model=new_query.model, view=new_query.view, fields=new_query.fields,
@@ -1596,56 +2151,141 @@ async def execute_report_and_get_url(
                 base64_image = base64.b64encode(image_bytes).decode('utf-8')
                 image_src_data_uri = f"data:image/png;base64,{base64_image}"
 
-                placeholder_tag = f"{{{{{placeholder_name}}}}}"
-                full_img_tag = f'<img src="{image_src_data_uri}" style="max-width:100%; height:auto;" />'
-
-                wrapped_placeholder_regex = re.compile(f'<img[^>]*src=[\'"]{re.escape(placeholder_tag)}[\'"][^>]*>', re.IGNORECASE)
-                populated_html = wrapped_placeholder_regex.sub(placeholder_tag, populated_html)
-                populated_html = populated_html.replace(placeholder_tag, full_img_tag)
+                substitutions.setdefault(str(placeholder_name), f'<img src="{image_src_data_uri}" style="max-width:100%; height:auto;" />')
 
             except Exception as e:
-                placeholder_tag = f"{{{{{placeholder_name}}}}}"
                 error_message = f"Error rendering chart: {e}"
-                print(f"ERROR: Failed to render Look {look_id}: {e}")
-                populated_html = populated_html.replace(placeholder_tag, error_message)
+                logger.error("Failed to render Look %s: %s", look_id, e)
+                substitutions.setdefault(str(placeholder_name), error_message)
+
+    populated_html = _render_report_template(compiled_template, substitutions)
 
     # --- Final GCS Upload block ---
     try:
-        report_id = str(uuid.uuid4())
+        # 128 random bits, URL-safe as is; the id is the only thing guarding the unauthenticated view URL.
+        report_id = secrets.token_urlsafe(16)
         output_gcs_blob_name = f"{config.GCS_GENERATED_REPORTS_PREFIX}{report_id}.html"
         bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
         blob_out = bucket.blob(output_gcs_blob_name)
-        blob_out.upload_from_string(populated_html, content_type='text/html; charset=utf-8')
-        print(f"INFO: Successfully generated and saved report to gs://{config.GCS_BUCKET_NAME}/{output_gcs_blob_name}")
+        # The GCS write and the Redis copy are independent round-trips; a Redis copy orphaned by a failed upload
+        # is never linked to and simply expires.
+        # Encoded once and shared, rather than each writer encoding its own copy of a possibly large document.
+        populated_html_bytes = populated_html.encode('utf-8')
+
+        async def share_compressed_report() -> bytes:
+            compressed_html = await asyncio.to_thread(_compress_generated_report, populated_html_bytes)
+            await _share_generated_report(report_id, compressed_html)
+            return compressed_html
+
+        _, compressed_html = await asyncio.gather(asyncio.to_thread(blob_out.upload_from_string, populated_html_bytes, content_type='text/html; charset=utf-8'),
+                                                  share_compressed_report())
+        _remember_generated_report(report_id, compressed_html)
+        logger.info("Successfully generated and saved report to gs://%s/%s", config.GCS_BUCKET_NAME, output_gcs_blob_name)
     except Exception as e:
-        print(f"FATAL: Could not upload final report to GCS. Error: {e}")
-        import traceback; traceback.print_exc() 
+        logger.critical("Could not upload final report to GCS. Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to save final report to GCS: {str(e)}")
         
     report_url_path = f"/view_generated_report/{report_id}"
-    return JSONResponse(content={"report_url_path": report_url_path})
+    return ORJSONResponse(content={"report_url_path": report_url_path})
+
+def _generated_report_redis_key(report_id: str) -> str: return f"report:{report_id}"
+
+# The worker cache and Redis hold reports gzip-compressed (table markup compresses several-fold); GCS keeps plain HTML.
+def _compress_generated_report(html_bytes: bytes) -> bytes: return gzip.compress(html_bytes, compresslevel=6)
+
+def _remember_generated_report(report_id: str, compressed_html: bytes) -> None:
+    # A single report larger than the whole budget is served from Redis/GCS instead of evicting everything else.
+    if len(compressed_html) <= generated_reports_cache.maxsize: generated_reports_cache[report_id] = compressed_html
+
+async def _share_generated_report(report_id: str, compressed_html: bytes) -> None:
+    if config.redis_client is None: return
+    try: await config.redis_client.setex(_generated_report_redis_key(report_id), config.GENERATED_REPORTS_CACHE_TTL_SECONDS, compressed_html)
+    except Exception as e: logger.warning("Could not cache report %s in Redis: %s", report_id, e)
+
+async def _get_shared_generated_report(report_id: str) -> Optional[bytes]:
+    if config.redis_client is None: return None
+    try: cached = await config.redis_client.get(_generated_report_redis_key(report_id))
+    except Exception as e:
+        logger.warning("Could not read report %s from Redis: %s", report_id, e); return None
+    # Copies shared before reports were stored compressed are plain HTML until their TTL runs out.
+    if cached is not None and not cached.startswith(b"\x1f\x8b"): cached = await asyncio.to_thread(_compress_generated_report, cached)
+    return cached
+
+def _accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    # RFC 9110 codings with q-values: "gzip;q=0" is a refusal, and "*" covers gzip only when gzip is not listed itself.
+    gzip_q, wildcard_q = None, None
+    for coding in (accept_encoding or "").lower().split(","):
+        name, _, params = coding.partition(";")
+        name, q = name.strip(), 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try: q = float(value)
+                except ValueError: q = 0.0
+        if name in ("gzip", "x-gzip"): gzip_q = q if gzip_q is None else max(gzip_q, q)
+        elif name == "*": wildcard_q = q
+    if gzip_q is None: gzip_q = wildcard_q
+    return gzip_q is not None and gzip_q > 0
+
+def _generated_report_response(compressed_html: bytes, accept_encoding: Optional[str], headers: Dict[str, str]) -> Response:
+    # Clients that accept gzip (every browser) get the stored bytes as-is; anyone else gets them inflated.
+    headers = {**headers, "Vary": "Accept-Encoding"}
+    if _accepts_gzip(accept_encoding):
+        return Response(content=compressed_html, media_type="text/html; charset=utf-8", headers={**headers, "Content-Encoding": "gzip"})
+    return HTMLResponse(content=gzip.decompress(compressed_html), headers=headers)
 
 @app.get("/view_generated_report/{report_id}", response_class=HTMLResponse)
 async def view_generated_report_endpoint(
-    report_id: str, gcs_client: storage.Client = Depends(get_storage_client_dep)
+    report_id: str, accept_encoding: Optional[str] = Header(None), gcs_client: storage.Client = Depends(get_storage_client_dep)
 ):
     generated_report_gcs_blob_name = f"{config.GCS_GENERATED_REPORTS_PREFIX}{report_id}.html"
-    html_content: Optional[str] = None
-    try:
-        bucket = gcs_client.bucket(config.GCS_BUCKET_NAME)
-        blob_in = bucket.blob(generated_report_gcs_blob_name)
-        if blob_in.exists():
-            html_content = blob_in.download_as_text(encoding='utf-8')
-        else: raise HTTPException(status_code=404, detail="Report not found or has expired.")
-    except GCSNotFound: raise HTTPException(status_code=404, detail="Report not found (GCS).")
-    except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to retrieve report: {str(e)}")
-    if not html_content: raise HTTPException(status_code=404, detail="Report content is empty.")
     headers = {"Cache-Control": "no-store, no-cache, must-revalidate, max-age=0", "Pragma": "no-cache", "Expires": "0"}
-    return HTMLResponse(content=html_content, headers=headers)
+    compressed_html: Optional[bytes] = generated_reports_cache.get(report_id)
+    if compressed_html is None:
+        compressed_html = await _get_shared_generated_report(report_id)
+        if compressed_html is not None: _remember_generated_report(report_id, compressed_html)
+    if compressed_html is None:
+        chunk_size = config.GENERATED_REPORT_STREAM_CHUNK_BYTES
+        try:
+            reader = gcs_client.bucket(config.GCS_BUCKET_NAME).blob(generated_report_gcs_blob_name).open("rb", chunk_size=chunk_size)
+            # Reading the first chunk up front surfaces NotFound as a 404 before any response bytes are sent.
+            first_chunk = await asyncio.to_thread(reader.read, chunk_size)
+        except GCSNotFound: raise HTTPException(status_code=404, detail="Report not found or has expired.")
+        except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to retrieve report: {str(e)}")
+        if not first_chunk: raise HTTPException(status_code=404, detail="Report content is empty.")
+        if len(first_chunk) < chunk_size:
+            reader.close()
+            compressed_html = await asyncio.to_thread(_compress_generated_report, first_chunk)
+            _remember_generated_report(report_id, compressed_html)
+        else:
+            # Large reports are forwarded chunk by chunk so the browser starts rendering before the whole object is downloaded.
+            async def stream_report_chunks():
+                # Chunks are gzipped as they go out, so only the compressed copy is held for the worker cache, and only while it fits.
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                compressed_parts = [await asyncio.to_thread(compressor.compress, first_chunk)]
+                compressed_size = len(compressed_parts[0])
+                try:
+                    yield first_chunk
+                    while chunk := await asyncio.to_thread(reader.read, chunk_size):
+                        if compressed_parts is not None:
+                            compressed_parts.append(await asyncio.to_thread(compressor.compress, chunk))
+                            compressed_size += len(compressed_parts[-1])
+                            if compressed_size > generated_reports_cache.maxsize: compressed_parts = None
+                        yield chunk
+                    if compressed_parts is not None:
+                        compressed_parts.append(compressor.flush())
+                        _remember_generated_report(report_id, b"".join(compressed_parts))
+                finally: reader.close()
+            return StreamingResponse(stream_report_chunks(), media_type="text/html; charset=utf-8", headers=headers)
+    return _generated_report_response(compressed_html, accept_encoding, headers)
 
 
 if __name__ == "__main__":
-    print("INFO: Starting Uvicorn server for GenAI Report API.")
+    logger.info("Starting Uvicorn server for GenAI Report API.")
     default_port = int(os.getenv("PORT", "8080"))
-    reload_flag = os.getenv("PYTHON_ENV", "development").lower() == "development"
-    uvicorn.run("app:app", host="0.0.0.0", port=default_port, reload=reload_flag)
\ No newline at end of file
+    if os.getenv("PYTHON_ENV", "development").lower() == "development":
+        uvicorn.run("app:app", host="0.0.0.0", port=default_port, reload=True)
+    else:
+        # Same shape as the container CMD: one process per core unless WEB_CONCURRENCY says otherwise, no file watcher.
+        uvicorn.run("app:app", host="0.0.0.0", port=default_port, workers=int(os.getenv("WEB_CONCURRENCY") or os.cpu_count() or 1),
+                    loop="uvloop", http="httptools", log_level="warning")
\ No newline at end of file